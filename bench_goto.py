@@ -0,0 +1,320 @@
+# Benchmarks for goto. Run all of them with `python bench_goto.py`, or
+# only some by passing their names, e.g. `python bench_goto.py threads`.
+
+import array
+import subprocess
+import sys
+import threading
+import timeit
+
+import goto
+from goto import with_goto
+
+CODE = '''\
+i = 0
+result = []
+
+label .start
+if i == 10:
+    goto .end
+
+result.append(i)
+i += 1
+goto .start
+
+label .end
+'''
+
+
+def _best_of(func, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        func()
+        times.append(timeit.default_timer() - start)
+    return min(times)
+
+
+def _report(name, seconds, extra=''):
+    print('  %-40s %10.3f ms%s' % (name, seconds * 1000, extra))
+
+
+def _make_function(lines):
+    source = 'def func():\n' + ''.join('    %s\n' % line for line in lines)
+    ns = {}
+    exec(source, ns)
+    return ns['func']
+
+
+def _labels_function(n_labels):
+    # n_labels labels, each also the target of a goto
+    lines = ['i = 0']
+    for i in range(n_labels):
+        lines.append('label .l%d' % i)
+        lines.append('i += 1')
+        lines.append('goto .l%d' % (i + 1))
+    lines.append('label .l%d' % n_labels)
+    lines.append('return i')
+    return _make_function(lines)
+
+
+def bench_patch():
+    # time to analyze and rewrite large functions, bypassing the caches
+    print('patch')
+    for n_labels in (1000, 10000, 30000):
+        code = _labels_function(n_labels).__code__
+        seconds = _best_of(lambda: goto._rewrite_code(code), repeat=3)
+        _report('%d labels (%d bytes)' % (n_labels, len(code.co_code)),
+                seconds)
+
+
+def bench_scan():
+    # time to find the labels and gotos, with and without NumPy
+    print('scan')
+    numpy = goto._import_numpy()
+    for n_labels in (1000, 10000, 30000):
+        code = _labels_function(n_labels).__code__
+        instructions = goto._Instructions(code.co_code)
+        scanners = [('python', False)]
+        if numpy:
+            scanners.append(('numpy', numpy))
+        for scanner, goto._numpy in scanners:
+            try:
+                seconds = _best_of(lambda: goto._find_labels_and_gotos(
+                    code, instructions), repeat=3)
+            finally:
+                goto._numpy = numpy
+            _report('%d labels, %s' % (n_labels, scanner), seconds)
+
+
+def bench_encoder():
+    # time to build the encoder tables (done once, on import) compared to
+    # importing goto, and to emit ops with the specialized and generic writer
+    print('encoder')
+    bytecode = goto._BYTECODE
+    _report('build tables', _best_of(bytecode._init_encoder))
+    command = [sys.executable, '-c', 'import goto']
+    baseline = _best_of(lambda: subprocess.check_call(command[:2] + ['pass']))
+    _report('import goto', _best_of(lambda: subprocess.check_call(command))
+            - baseline, '  (excluding interpreter startup)')
+
+    ops = [('LOAD_CONST', i % 300) for i in range(100000)]
+    buf = array.array('B', [0] * 8 * len(ops))
+    for name, write in (('specialized', bytecode.write_instruction),
+                        ('generic', bytecode._write_generic)):
+        def emit():
+            pos = 0
+            for op in ops:
+                pos = write(buf, pos, *op)
+        _report('emit %d ops, %s' % (len(ops), name), _best_of(emit))
+
+
+def bench_nesting():
+    # time to scan functions with many labels and gotos inside deeply
+    # nested loops, each of which saves the whole block stack
+    print('nesting')
+    for depth in (5, 10, 15):
+        lines = ['i = 0']
+        for level in range(depth):
+            lines.append('%sfor x%d in range(1):' % ('    ' * level, level))
+        indent = '    ' * depth
+        for i in range(2000):
+            lines.append('%slabel .l%d' % (indent, i))
+            lines.append('%sgoto .l%d' % (indent, i))
+        lines.append('return i')
+        code = _make_function(lines).__code__
+        seconds = _best_of(lambda: goto._find_labels_and_gotos(code), repeat=3)
+        _report('depth %d, 2000 labels' % depth, seconds)
+
+
+def bench_compact():
+    # run time of a loop built from labels and gotos, patched in place (with
+    # NOP sleds) and reassembled with compact=True
+    print('compact')
+    lines = ['i = 0', 'total = 0',
+             'label .loop',
+             'if i == 100000:', '    goto .end',
+             'label .a', 'total += i',
+             'label .b', 'i += 1',
+             'goto .loop',
+             'label .end',
+             'return total']
+    func = _make_function(lines)
+    for name, compact in (('in place', False), ('compact', True)):
+        patched = with_goto(func, compact=compact)
+        _report('%s (%d bytes)' % (name, len(patched.__code__.co_code)),
+                _best_of(patched))
+
+
+def bench_consts():
+    # time to patch functions with many constants, and as many gotos
+    # injecting a constant (the index into goto.params)
+    print('consts')
+    for n in (1000, 5000, 20000):
+        lines = ['x = %r' % ('c%d' % i) for i in range(n)]
+        lines += ['if x == %r: goto.params .loop = (),' % ('c%d' % i)
+                  for i in range(n)]
+        lines += ['for i in ():', '    label .loop']
+        code = _make_function(lines).__code__
+        seconds = _best_of(lambda: goto._rewrite_code(code), repeat=3)
+        _report('%d consts, %d gotos' % (n, n), seconds)
+
+
+def bench_scaling():
+    # patch time per label should stay about the same as functions grow,
+    # also past 64 KiB of bytecode and 65536 names
+    print('scaling')
+    for n_labels in (100, 1000, 10000, 100000):
+        code = _labels_function(n_labels).__code__
+        for name, compact in (('in place', False), ('compact', True)):
+            options = goto._DEFAULT_OPTIONS._replace(compact=compact)
+            seconds = _best_of(lambda: goto._rewrite_code(code, options),
+                               repeat=1 if n_labels >= 100000 else 3)
+            _report('%d labels, %s' % (n_labels, name), seconds,
+                    '  (%.1f us/label)' % (seconds / n_labels * 1e6))
+
+
+def bench_threads(n_codes=200):
+    # every thread patches the same generated code objects, so without
+    # single-flight patching the work would be repeated per thread
+    print('threads (%d code objects, GIL %s)' % (
+        n_codes, 'enabled' if getattr(sys, '_is_gil_enabled',
+                                      lambda: True)() else 'disabled'))
+    for workers in (1, 2, 4, 8):
+        codes = [compile(CODE + 'x = %d\n' % i, '<bench>', 'exec')
+                 for i in range(n_codes)]
+        goto.cache_clear()
+        barrier = threading.Event()
+
+        def patch_all():
+            barrier.wait()
+            for code in codes:
+                with_goto(code)
+
+        threads = [threading.Thread(target=patch_all) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        start = timeit.default_timer()
+        barrier.set()
+        for thread in threads:
+            thread.join()
+        seconds = timeit.default_timer() - start
+        _report('%d workers' % workers, seconds,
+                '  (%d patched)' % goto.cache_info().misses)
+
+
+def _count_instructions(func):
+    # the number of instructions func() executes, traced opcode by opcode
+    counts = [0]
+
+    def trace(frame, event, arg):
+        if frame.f_code is func.__code__:
+            frame.f_trace_opcodes = True
+            if event == 'opcode':
+                counts[0] += 1
+        return trace
+
+    sys.settrace(trace)
+    try:
+        func()
+    finally:
+        sys.settrace(None)
+    return counts[0]
+
+
+def bench_thread_jumps(n_states=10, n_transitions=100000):
+    # a state machine whose transitions go through a label followed by
+    # another goto, and whose exit check is an `if` around a goto
+    print('thread_jumps (%d transitions)' % n_transitions)
+    lines = ['n = 0', 'goto .s0']
+    for i in range(n_states):
+        lines += ['label .s%d' % i,
+                  'n += 1',
+                  'if n == %d:' % n_transitions, '    goto .exit',
+                  'goto .hop%d' % i,
+                  'label .hop%d' % i,
+                  'goto .s%d' % ((i + 1) % n_states)]
+    lines += ['label .exit', 'goto .end', 'label .end', 'return n']
+    func = _make_function(lines)
+    for compact in (False, True):
+        for thread_jumps in (False, True):
+            patched = with_goto(func, compact=compact, thread_jumps=thread_jumps)
+            extra = ''
+            if hasattr(sys, 'settrace') and sys.version_info >= (3, 7):
+                extra = '  (%.1f instructions/transition)' % (
+                    _count_instructions(patched) / float(n_transitions))
+            _report('%s%s' % ('compact' if compact else 'in place',
+                              ', threaded' if thread_jumps else ''),
+                    _best_of(patched), extra)
+
+
+def _bench_helper(x):
+    return x
+
+
+def bench_bind_globals(n=100000):
+    # run time of a goto loop calling builtins and a module-level helper,
+    # with the globals looked up on every call and bound when patching
+    print('bind_globals (%d iterations)' % n)
+    lines = ['i = 0', 'total = 0', 'items = [1, 2, 3]',
+             'label .loop',
+             'if i == %d:' % n, '    goto .end',
+             'if isinstance(items, list):',
+             '    total += len(items) + _bench_helper(i)',
+             'i += 1',
+             'goto .loop',
+             'label .end',
+             'return total']
+    source = 'def func():\n' + ''.join('    %s\n' % line for line in lines)
+    ns = {'_bench_helper': _bench_helper}
+    exec(source, ns)
+    func = ns['func']
+    for name, bind in (('globals', False), ('bound', True)):
+        patched = with_goto(func, bind_globals=bind)
+        _report(name, _best_of(patched))
+
+
+def bench_params(n_jumps=20000):
+    # jumps into deeply nested loops with goto.params, each loop getting an
+    # empty iterable, so the loops exit right away
+    print('params (%d jumps)' % n_jumps)
+    for depth in (1, 2, 4, 8):
+        lines = ['i = 0',
+                 'label .start',
+                 'if i == %d:' % n_jumps, '    goto .end',
+                 'i += 1',
+                 'goto.params .inner = %s' % ('(), ' * depth)]
+        for level in range(depth):
+            lines.append('%sfor x%d in ():' % ('    ' * level, level))
+        lines.append('%slabel .inner' % ('    ' * depth))
+        lines += ['goto .start', 'label .end', 'return i']
+        patched = with_goto(_make_function(lines))
+        extra = ''
+        if sys.version_info >= (3, 7):
+            extra = '  (%.1f instructions/jump)' % (
+                _count_instructions(patched) / float(n_jumps))
+        _report('depth %d' % depth, _best_of(patched), extra)
+
+
+BENCHMARKS = {
+    'bind_globals': bench_bind_globals,
+    'compact': bench_compact,
+    'consts': bench_consts,
+    'encoder': bench_encoder,
+    'nesting': bench_nesting,
+    'params': bench_params,
+    'patch': bench_patch,
+    'scaling': bench_scaling,
+    'scan': bench_scan,
+    'thread_jumps': bench_thread_jumps,
+    'threads': bench_threads,
+}
+
+
+def main(names):
+    for name in names or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
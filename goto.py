@@ -5,10 +5,72 @@ import dis
 import struct
 import array
 import sys
+import os
 import types
 import functools
+import collections
+import gc
+import importlib
+import threading
 import weakref
 import warnings
+import time
+import __future__
+
+__version__ = '1.2'
+
+# compile() is left out, so a star import doesn't shadow the builtin
+__all__ = [
+    'with_goto', 'label', 'goto', 'patch_module', 'patch_class', 'prepatch',
+    'picklable', 'install_import_hook', 'cache_info', 'cache_clear',
+    'set_cache_maxsize', 'set_cache_dir', 'set_keep_original', 'memory_info',
+]
+
+try:
+    import builtins
+    import copyreg
+except ImportError:
+    import __builtin__ as builtins  # PY2
+    import copy_reg as copyreg
+
+_builtin_compile = builtins.compile
+
+try:
+    _replace_file = os.replace
+except AttributeError:
+    _replace_file = os.rename  # atomic on POSIX, which is all py2 needs here
+
+try:
+    from importlib import machinery as _machinery
+    from importlib import util as _importlib_util
+    _machinery.PathFinder.find_spec  # PY3.4+
+except (ImportError, AttributeError):
+    _machinery = None
+
+if _machinery is not None:
+    _MAGIC_NUMBER = _importlib_util.MAGIC_NUMBER
+else:
+    import imp
+    _MAGIC_NUMBER = imp.get_magic()
+
+try:
+    _perf_counter = time.perf_counter
+except AttributeError:
+    _perf_counter = time.time
+
+# NumPy, once the first code object big enough to be scanned with it is
+# patched (see _import_numpy()), or False if it isn't available
+_numpy = None
+
+# functions with at least this many instructions are scanned with NumPy,
+# if it's available (below it, converting the arrays costs more than it saves)
+_NUMPY_SCAN_THRESHOLD = 2048
+
+_GOTO_NAMES = frozenset(('goto', 'label'))
+
+# added to co_names of patched code, so it isn't patched again when it is
+# e.g. loaded from a .pyc written by the import hook
+_PATCHED_MARKER = 'goto.patched'
 
 try:
     _array_to_bytes = array.array.tobytes
@@ -16,12 +78,18 @@ except AttributeError:
     _array_to_bytes = array.array.tostring
 
 
+# placeholder for LOAD_CONST of None in op sequences built in advance
+_LOAD_NONE = ('LOAD_CONST', None)
+
+
 class _Bytecode:
     def __init__(self):
         x, y = None, None
         code = (lambda: x if x else y).__code__.co_code
         opcode, oparg = struct.unpack_from('BB', code, 2)
-        self.name_divisor = 1
+        # opcode -> shift to get the index into co_names from the argument,
+        # where the lowest bit(s) are used for flags
+        self.name_shifts = {}
 
         # Starting with Python 3.6, the bytecode format has been changed to use
         # 16-bit words (8-bit opcode + 8-bit argument) for each instruction,
@@ -33,7 +101,9 @@ class _Bytecode:
             self.argument = struct.Struct('B')
             self.jump_unit = 2
             self.have_argument = 0
-            self.name_divisor = 2
+            self.name_shifts[dis.opmap['LOAD_GLOBAL']] = 1
+            if sys.version_info >= (3, 12):
+                self.name_shifts[dis.opmap['LOAD_ATTR']] = 1
         elif dis.opname[opcode] == 'POP_JUMP_IF_FALSE':
             self.argument = struct.Struct('B')
             self.have_argument = 0
@@ -61,102 +131,626 @@ class _Bytecode:
         except ImportError:
             self.pypy_finally_semantics = False
 
-    @property
-    def argument_bits(self):
-        return self.argument.size * 8
+        self.argument_bits = self.argument.size * 8
+        self.hasjrel = frozenset(dis.hasjrel)
+        self.hasjabs = frozenset(dis.hasjabs)
+        self.backward_jumps = frozenset(
+            op for name, op in dis.opmap.items() if 'BACKWARD' in name)
+        # instructions after which execution doesn't continue with the next
+        # one (their targets, if any, are reachable as jump targets)
+        self.no_fallthrough = frozenset(name for name in (
+            'JUMP_ABSOLUTE', 'JUMP_FORWARD', 'JUMP_BACKWARD', 'RETURN_VALUE',
+            'RAISE_VARARGS', 'RERAISE', 'BREAK_LOOP', 'CONTINUE_LOOP',
+        ) if name in dis.opmap)
+        self.cache_opcode = dis.opmap.get('CACHE')
+        self.wordcode = (self.argument.size == 1 and self.have_argument == 0)
+        # opcodes _find_labels_and_gotos looks at, others are skipped
+        self.scanned_ops = frozenset(dis.opmap[name] for name in (
+            'LOAD_GLOBAL', 'LOAD_NAME', 'SETUP_LOOP', 'FOR_ITER',
+            'SETUP_EXCEPT', 'SETUP_FINALLY', 'SETUP_WITH', 'SETUP_ASYNC_WITH',
+            'POP_EXCEPT', 'END_FINALLY', 'WITH_CLEANUP', 'WITH_CLEANUP_START',
+            'WITH_EXCEPT_START', 'JUMP_ABSOLUTE', 'JUMP_FORWARD',
+        ) if name in dis.opmap)
+
+        self._init_encoder()
+
+    def init_numpy_tables(self, np):
+        load_ops = [dis.opmap[name] for name in ('LOAD_GLOBAL', 'LOAD_NAME')]
+        self.numpy_hasjrel = np.array(sorted(self.hasjrel), dtype=np.uint8)
+        self.numpy_hasjabs = np.array(sorted(self.hasjabs), dtype=np.uint8)
+        self.numpy_backward_jumps = np.array(sorted(self.backward_jumps),
+                                             dtype=np.uint8)
+        self.numpy_load_ops = np.array(load_ops, dtype=np.uint8)
+        self.numpy_load_attr = dis.opmap['LOAD_ATTR']
+        self.numpy_site_ends = np.array(
+            [dis.opmap['POP_TOP'], dis.opmap['STORE_ATTR']], dtype=np.uint8)
+        self.numpy_block_ops = np.array(
+            sorted(self.scanned_ops.difference(load_ops)), dtype=np.uint8)
+
+    def _init_encoder(self):
+        # opname -> opcode and opname -> size (without EXTENDED_ARGs)
+        self.opcodes = dict(dis.opmap)
+        self.sizes = dict(
+            (name, 1 + self.argument.size if op >= self.have_argument else 1)
+            for name, op in dis.opmap.items())
+        if self.relative_jumps_only:
+            # written as JUMP_FORWARD or JUMP_BACKWARD
+            self.sizes['JUMP_ABSOLUTE'] = self.sizes['JUMP_FORWARD']
+        self.max_argument = (1 << self.argument_bits) - 1
+
+        if self.relative_jumps_only:
+            self.write_instruction = self._write_generic
+        elif self.wordcode:
+            self.write_instruction = self._write_wordcode
+        else:
+            self.write_instruction = self._write_legacy
+
+        nop = dis.opmap['NOP']
+        self.nop = array.array('B', [nop, 0] if self.wordcode else [nop])
+
+        # ops that pop a block of the given type when jumping out of it,
+        # where _LOAD_NONE is replaced with the index of the None constant
+        pop_blocks = {
+            'FOR_ITER': () if self.has_loop_blocks else ('POP_TOP',),
+            '<EXCEPT>': ('POP_EXCEPT',),
+            '<FINALLY>': ('END_FINALLY',),
+        }
+        for block in ('SETUP_LOOP', 'SETUP_EXCEPT', 'SETUP_FINALLY',
+                      'SETUP_WITH', 'SETUP_ASYNC_WITH'):
+            ops = ['POP_BLOCK']
+            if block in ('SETUP_WITH', 'SETUP_ASYNC_WITH'):
+                ops.append('POP_TOP')
+            # pypy 3.6 keeps a block around until END_FINALLY;
+            # python 3.8 reuses SETUP_FINALLY for SETUP_EXCEPT
+            # (where END_FINALLY is not accepted).
+            # What will pypy 3.8 do?
+            if self.pypy_finally_semantics and \
+                    block in ('SETUP_FINALLY', 'SETUP_WITH',
+                              'SETUP_ASYNC_WITH'):
+                if self.has_begin_finally:
+                    ops.append('BEGIN_FINALLY')
+                else:
+                    ops.append(_LOAD_NONE)
+                ops.append('END_FINALLY')
+            pop_blocks[block] = tuple(ops)
+        self.pop_block_ops = pop_blocks
+
+        # ops that push a <FINALLY> block when jumping into it
+        ops = []
+        if self.pypy_finally_semantics:
+            ops.append('SETUP_FINALLY')
+            ops.append('POP_BLOCK')
+        if self.has_begin_finally:
+            ops.append('BEGIN_FINALLY')
+        else:
+            ops.append(_LOAD_NONE)
+        self.push_finally_ops = tuple(ops)
+
+        self.setup_except = 'SETUP_EXCEPT' if self.has_setup_except else \
+            'SETUP_FINALLY'
+
+    def instruction_size(self, opname, oparg=0):
+        size = self.sizes[opname]
+        if oparg > self.max_argument:
+            bits = self.argument_bits
+            while oparg > self.max_argument:
+                oparg >>= bits
+                size += self.sizes['EXTENDED_ARG']
+        return size
+
+    def _write_wordcode(self, buf, pos, opname, oparg=0):
+        if oparg > 0xff:
+            extended_arg = self.opcodes['EXTENDED_ARG']
+            if oparg > 0xffff:
+                if oparg > 0xffffff:
+                    buf[pos] = extended_arg
+                    buf[pos + 1] = (oparg >> 24) & 0xff
+                    pos += 2
+                buf[pos] = extended_arg
+                buf[pos + 1] = (oparg >> 16) & 0xff
+                pos += 2
+            buf[pos] = extended_arg
+            buf[pos + 1] = (oparg >> 8) & 0xff
+            pos += 2
+            oparg &= 0xff
+        buf[pos] = self.opcodes[opname]
+        buf[pos + 1] = oparg
+        return pos + 2
+
+    def _write_legacy(self, buf, pos, opname, oparg=0):
+        if oparg > 0xffff:
+            buf[pos] = self.opcodes['EXTENDED_ARG']
+            buf[pos + 1] = (oparg >> 16) & 0xff
+            buf[pos + 2] = (oparg >> 24) & 0xff
+            pos += 3
+            oparg &= 0xffff
+        opcode = buf[pos] = self.opcodes[opname]
+        if opcode < self.have_argument:
+            return pos + 1
+        buf[pos + 1] = oparg & 0xff
+        buf[pos + 2] = oparg >> 8
+        return pos + 3
+
+    def _write_generic(self, buf, pos, opname, oparg=0):
+        # Python 3.11 and above are special, no more absolute jumps.
+        if opname == 'JUMP_ABSOLUTE' and self.relative_jumps_only:
+            # TODO: Our offset calculation is definitely not right.
+            jump_relative_point = pos + 2
+            jump_target = oparg * self.jump_unit
+            if jump_relative_point >= jump_target:
+                opname = 'JUMP_BACKWARD'
+                oparg = jump_relative_point - jump_target
+            else:
+                opname = 'JUMP_FORWARD'
+                oparg = jump_target - jump_relative_point
+
+        extended_arg = oparg >> self.argument_bits
+        if extended_arg != 0:
+            pos = self._write_generic(buf, pos, 'EXTENDED_ARG', extended_arg)
+            oparg &= self.max_argument
+
+        opcode = self.opcodes[opname]
+        buf[pos] = opcode
+        pos += 1
+
+        if opcode >= self.have_argument:
+            self.argument.pack_into(buf, pos, oparg)
+            pos += self.argument.size
+
+        return pos
+
+    def write_nops(self, buf, pos, end):
+        buf[pos:end] = self.nop * ((end - pos) // len(self.nop))
+
+    def decode(self, instructions, code):
+        if self.wordcode and (self.cache_opcode is None or
+                              struct.pack('B', self.cache_opcode) not in code[0::2]):
+            self._decode_wordcode(instructions, code)
+        else:
+            self._decode_slow(instructions, code)
+
+    def _decode_wordcode(self, instructions, code):
+        # Slices the opcodes and arguments out of the code in bulk, then
+        # folds each run of EXTENDED_ARGs into the instruction that follows
+        ops = code[0::2]
+        opcodes = array.array('B', ops)
+        args = array.array('l', array.array('B', code[1::2]))
+        offsets = array.array('l', range(0, len(code), 2))
+
+        extended_arg_op = dis.EXTENDED_ARG
+        extended_arg = struct.pack('B', extended_arg_op)
+        i = ops.find(extended_arg)
+        if i == -1:
+            instructions.opcodes = opcodes
+            instructions.args = args
+            instructions.offsets = offsets
+            return
+
+        new_opcodes = array.array('B')
+        new_args = array.array('l')
+        new_offsets = array.array('l')
+        start = 0
+        while i != -1:
+            new_opcodes.extend(opcodes[start:i])
+            new_args.extend(args[start:i])
+            new_offsets.extend(offsets[start:i])
+            j = i
+            arg = 0
+            while opcodes[j] == extended_arg_op:
+                arg = (arg | args[j]) << 8
+                j += 1
+            new_opcodes.append(opcodes[j])
+            new_args.append(arg | args[j])
+            new_offsets.append(offsets[i])
+            start = j + 1
+            i = ops.find(extended_arg, start)
+        new_opcodes.extend(opcodes[start:])
+        new_args.extend(args[start:])
+        new_offsets.extend(offsets[start:])
+
+        instructions.opcodes = new_opcodes
+        instructions.args = new_args
+        instructions.offsets = new_offsets
+
+    def _decode_slow(self, instructions, code):
+        raw = array.array('B', code)
+        opcodes = array.array('B')
+        args = array.array('l')
+        offsets = array.array('l')
+        have_argument = self.have_argument
+        wide = self.argument.size == 2
+        bits = self.argument_bits
+        extended_arg_op = dis.EXTENDED_ARG
+        cache_op = self.cache_opcode
+
+        extended_arg = 0
+        extended_arg_offset = None
+        pos = 0
+        end = len(raw)
+        while pos < end:
+            offset = pos
+            if extended_arg_offset is not None:
+                offset = extended_arg_offset
+
+            op = raw[pos]
+            pos += 1
+            arg = 0
+            if op >= have_argument:
+                if wide:
+                    arg = extended_arg | raw[pos] | (raw[pos + 1] << 8)
+                    pos += 2
+                else:
+                    arg = extended_arg | raw[pos]
+                    pos += 1
+                if op == extended_arg_op:
+                    extended_arg = arg << bits
+                    extended_arg_offset = offset
+                    continue
+
+            extended_arg = 0
+            extended_arg_offset = None
+            if op == cache_op:
+                # Not a real instruction, just an inline `CACHE` for
+                # Python 3.11+
+                continue
+            opcodes.append(op)
+            args.append(arg)
+            offsets.append(offset)
+
+        instructions.opcodes = opcodes
+        instructions.args = args
+        instructions.offsets = offsets
 
 
 _BYTECODE = _Bytecode()
 
-# use a weak dictionary in case code objects can be garbage-collected
-_patched_code_cache = weakref.WeakKeyDictionary()
+
+class _LRUCache(object):
+    # a dictionary holding at most maxsize items, dropping the least
+    # recently used ones first
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.evictions = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            self._evict()
+
+    def _evict(self):
+        while self.maxsize is not None and len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def resize(self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def values(self):
+        with self._lock:
+            return list(self._data.values())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.evictions = 0
+
+
+class _IdentityCache(object):
+    # a dictionary keyed by the identity of objects, for code objects, which
+    # compare equal even when e.g. their co_filename differs. Entries go away
+    # with their key, or, given an _LRUCache to hold them, where keys can't
+    # be weakly referenced, are evicted from it.
+    def __init__(self, lru=None):
+        self._data = {} if lru is None else lru
+
+    def get(self, key, default=None):
+        entry = self._data.get(id(key))
+        if entry is None or entry[0]() is not key:
+            return default
+        return entry[1]
+
+    def __setitem__(self, key, value):
+        i = id(key)
+        if isinstance(self._data, _LRUCache):
+            ref = lambda: key
+        else:
+            def remove(ref):
+                entry = self._data.get(i)
+                if entry is not None and entry[0] is ref:
+                    self._data.pop(i, None)
+
+            ref = weakref.ref(key, remove)
+        self._data[i] = (ref, value)
+
+    @property
+    def evictions(self):
+        return getattr(self._data, 'evictions', 0)
+
+    def resize(self, maxsize):
+        if isinstance(self._data, _LRUCache):
+            self._data.resize(maxsize)
+
+    def __len__(self):
+        return len(self._data)
+
+    def values(self):
+        return [value for _, value in list(self._data.values())]
+
+    def clear(self):
+        self._data.clear()
+
+
+_DEFAULT_CACHE_MAXSIZE = 4096
+
+# patched code by the identity of the original code, weakly referenced in
+# case code objects can be garbage-collected
+_patched_code_cache = _IdentityCache()
+# patched code by a digest of the original code's contents, so code that
+# is equal but not identical (e.g. after importlib.reload) is only patched
+# once, and shares the patched code object
+_content_cache = weakref.WeakValueDictionary()
 try:
-    _patched_code_cache[_Bytecode.__init__.__code__] = None
+    weakref.ref(_Bytecode.__init__.__code__)
 except TypeError:
-    _patched_code_cache = {}  # ...unless not supported
+    # ...unless not supported
+    _patched_code_cache = _IdentityCache(_LRUCache(_DEFAULT_CACHE_MAXSIZE))
+    _content_cache = _LRUCache(_DEFAULT_CACHE_MAXSIZE)
+
+_cache_hits = 0
+_cache_misses = 0
+
+# opt-in persistent cache of patched code objects, see set_cache_dir()
+_cache_dir = os.environ.get('GOTO_CACHE_DIR') or None
+
+
+def _update_hash(h, value):
+    if not isinstance(value, bytes):
+        value = repr(value).encode('utf-8')
+    h.update(struct.pack('<I', len(value)))
+    h.update(value)
+
+
+def _hash_const(h, value):
+    _update_hash(h, type(value).__name__)
+    if isinstance(value, types.CodeType):
+        _hash_code(h, value)
+    elif isinstance(value, (tuple, frozenset)):
+        if isinstance(value, frozenset):
+            # iteration order of sets depends on the hash seed
+            value = sorted(value, key=repr)
+        _update_hash(h, len(value))
+        for item in value:
+            _hash_const(h, item)
+    else:
+        # repr() keeps apart what == doesn't, e.g. 0.0 and -0.0
+        _update_hash(h, value)
+
 
+_CODE_KEY_ATTRS = (
+    'co_argcount', 'co_posonlyargcount', 'co_kwonlyargcount', 'co_nlocals',
+    'co_stacksize', 'co_flags', 'co_code', 'co_names', 'co_varnames',
+    'co_freevars', 'co_cellvars', 'co_filename', 'co_name', 'co_qualname',
+    'co_firstlineno', 'co_lnotab', 'co_linetable', 'co_exceptiontable',
+)
 
-def _get_name(code, index):
-    return code.co_names[index // _BYTECODE.name_divisor]
 
+def _hash_code(h, code):
+    for attr in _CODE_KEY_ATTRS:
+        _update_hash(h, getattr(code, attr, None))
+    _update_hash(h, len(code.co_consts))
+    for const in code.co_consts:
+        _hash_const(h, const)
 
-def _make_code(code, codestring, data):
+
+def _code_digest(code):
+    import hashlib
+    h = hashlib.sha1()
+    _hash_code(h, code)
+    return h.hexdigest()
+
+
+def _disk_cache_path(digest, options):
+    import hashlib
+    h = hashlib.sha1()
+    _update_hash(h, (sys.version, tuple(sys.version_info), __version__))
+    _update_hash(h, digest)
+    if options != _DEFAULT_OPTIONS:
+        _update_hash(h, tuple(options))
+    return os.path.join(_cache_dir, h.hexdigest() + '.goto')
+
+
+def _read_disk_cache(path):
+    import marshal
     try:
-        # code.replace is new in 3.8+
-        return code.replace(co_code=codestring,
-                            co_nlocals=data.nlocals,
-                            co_varnames=data.varnames,
-                            co_consts=data.consts,
-                            co_names=data.names)
-    except:
-        args = [
-            code.co_argcount, data.nlocals, code.co_stacksize,
-            code.co_flags, codestring, data.consts,
-            data.names, data.varnames, code.co_filename,
-            code.co_name, code.co_firstlineno, code.co_lnotab,
-            code.co_freevars, code.co_cellvars
-        ]
+        with open(path, 'rb') as f:
+            new_code = marshal.load(f)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(new_code, types.CodeType):
+        return None
+    return new_code
+
 
+def _write_file_atomic(path, data, mode=None):
+    # write to a private file first and rename it into place, so concurrent
+    # readers either see the complete file or none at all; it is only
+    # readable by its owner, unless another mode is given
+    import tempfile
+    dirname = os.path.dirname(path)
+    try:
+        os.makedirs(dirname)
+    except OSError:
+        if not os.path.isdir(dirname):
+            raise
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        _replace_file(tmp_path, path)
+    except:
         try:
-            args.insert(1, code.co_kwonlyargcount)  # PY3
-        except AttributeError:
+            os.unlink(tmp_path)
+        except OSError:
             pass
-
-        return types.CodeType(*args)
+        raise
 
 
-def _parse_instructions(code, yield_nones_at_end=0):
-    extended_arg = 0
-    extended_arg_offset = None
-    pos = 0
+def _write_disk_cache(path, new_code):
+    import marshal
+    try:
+        data = marshal.dumps(new_code)
+    except ValueError:
+        return  # e.g. code objects built with unmarshallable constants
+    try:
+        _write_file_atomic(path, data)
+    except (IOError, OSError):
+        pass
 
-    while pos < len(code):
-        offset = pos
-        if extended_arg_offset is not None:
-            offset = extended_arg_offset
 
-        opcode = struct.unpack_from('B', code, pos)[0]
-        pos += 1
+def _get_name(code, opcode, oparg):
+    return code.co_names[oparg >> _BYTECODE.name_shifts.get(opcode, 0)]
 
-        oparg = None
-        if opcode >= _BYTECODE.have_argument:
-            oparg = extended_arg | _BYTECODE.argument.unpack_from(code, pos)[0]
-            pos += _BYTECODE.argument.size
 
-            if opcode == dis.EXTENDED_ARG:
-                extended_arg = oparg << _BYTECODE.argument_bits
-                extended_arg_offset = offset
-                continue
+def _make_code(code, codestring, data, **fields):
+    fields.update(co_code=codestring,
+                  co_nlocals=data.nlocals,
+                  co_varnames=tuple(data.varnames),
+                  co_consts=tuple(data.consts),
+                  co_names=tuple(data.names))
+    try:
+        # code.replace is new in 3.8+
+        return code.replace(**fields)
+    except:
+        def get(attr):
+            return fields[attr] if attr in fields else getattr(code, attr)
 
-        extended_arg = 0
-        extended_arg_offset = None
-        opname = dis.opname[opcode]
-        if opname == "CACHE":
-            # Not a real instruction, just an inline `CACHE` for
-            # Python 3.11+
-            continue
-        yield opname, oparg, offset
+        args = [
+            get('co_argcount'), get('co_nlocals'), get('co_stacksize'),
+            get('co_flags'), get('co_code'), get('co_consts'),
+            get('co_names'), get('co_varnames'), get('co_filename'),
+            get('co_name'), get('co_firstlineno'), get('co_lnotab'),
+            get('co_freevars'), get('co_cellvars')
+        ]
 
-    for _ in range(yield_nones_at_end):
-        yield None, None, None
+        try:
+            args.insert(1, get('co_kwonlyargcount'))  # PY3
+        except AttributeError:
+            pass
 
+        return types.CodeType(*args)
 
-def _get_instruction_size(opname, oparg=0):
-    size = 1
 
-    if opname == "JUMP_ABSOLUTE" and _BYTECODE.relative_jumps_only:
-        opname = "JUMP_FORWARD"
+class _Instructions(object):
+    # Bytecode decoded into parallel arrays of opcodes, arguments (with
+    # EXTENDED_ARG folded in) and offsets (of the first EXTENDED_ARG, if
+    # any). Inline CACHE entries (3.11+) are skipped. The arrays are padded
+    # with 3 entries of opcode 0 at offset len(code), so patterns can be
+    # matched without bounds checks.
+    __slots__ = ['opcodes', 'args', 'offsets', 'count']
 
-    extended_arg = oparg >> _BYTECODE.argument_bits
-    if extended_arg != 0:
-        size += _get_instruction_size('EXTENDED_ARG', extended_arg)
-        oparg &= (1 << _BYTECODE.argument_bits) - 1
+    def __init__(self, code):
+        _BYTECODE.decode(self, code)
+        self.count = len(self.opcodes)
+        self.opcodes.extend((0, 0, 0))
+        self.args.extend((0, 0, 0))
+        self.offsets.extend((len(code),) * 3)
+
+    def jump_targets(self):
+        targets = set()
+        opcodes = self.opcodes
+        offsets = self.offsets
+        args = self.args
+        unit = _BYTECODE.jump_unit
+        for i in range(self.count):
+            op = opcodes[i]
+            if op in _BYTECODE.hasjrel:
+                if op in _BYTECODE.backward_jumps:
+                    targets.add(offsets[i + 1] - args[i] * unit)
+                else:
+                    targets.add(offsets[i + 1] + args[i] * unit)
+            elif op in _BYTECODE.hasjabs:
+                targets.add(args[i] * unit)
+        return targets
+
+    def scan(self):
+        # Returns the jump targets, and the indices of the instructions
+        # _find_labels_and_gotos has to look at. Block exits are always
+        # jump targets of their SETUP_* instruction, so these are included.
+        if self.count < _NUMPY_SCAN_THRESHOLD:
+            return self.jump_targets(), range(self.count)
+        np = _numpy
+        if np is None:
+            np = _import_numpy()
+        if not np:
+            return self.jump_targets(), range(self.count)
+        return self._numpy_scan(np)
+
+    def _numpy_scan(self, np):
+        n = self.count
+        all_ops = np.frombuffer(self.opcodes, dtype=np.uint8)
+        args = np.frombuffer(self.args, dtype='l')[:n]
+        all_offsets = np.frombuffer(self.offsets, dtype='l')
+        ops = all_ops[:n]
+        offsets = all_offsets[:n]
+        next_offsets = all_offsets[1:n + 1]
+        unit = _BYTECODE.jump_unit
+
+        relative = np.isin(ops, _BYTECODE.numpy_hasjrel)
+        backward = np.isin(ops, _BYTECODE.numpy_backward_jumps)
+        forward = relative & ~backward
+        absolute = np.isin(ops, _BYTECODE.numpy_hasjabs)
+        targets = np.unique(np.concatenate((
+            next_offsets[forward] + args[forward] * unit,
+            next_offsets[backward] - args[backward] * unit,
+            args[absolute] * unit,
+        )))
+
+        # label and goto sites: LOAD_GLOBAL/LOAD_NAME, LOAD_ATTR, POP_TOP/STORE_ATTR
+        sites = np.isin(ops, _BYTECODE.numpy_load_ops)
+        sites &= all_ops[1:n + 1] == _BYTECODE.numpy_load_attr
+        sites &= np.isin(all_ops[2:n + 2], _BYTECODE.numpy_site_ends)
+
+        wanted = sites
+        wanted |= np.isin(ops, _BYTECODE.numpy_block_ops)
+        wanted |= np.isin(offsets, targets)
+        return set(targets.tolist()), np.flatnonzero(wanted).tolist()
+
+
+def _import_numpy():
+    # importing NumPy takes longer than importing goto, so it is only done
+    # for the first code object that is scanned with it
+    global _numpy
+    try:
+        import numpy
+    except ImportError:
+        _numpy = False
+    else:
+        _BYTECODE.init_numpy_tables(numpy)
+        _numpy = numpy
+    return _numpy
 
-    opcode = dis.opmap[opname]
-    if opcode >= _BYTECODE.have_argument:
-        size += _BYTECODE.argument.size
 
-    return size
+_get_instruction_size = _BYTECODE.instruction_size
+_write_instruction = _BYTECODE.write_instruction
 
 
 def _get_instructions_size(ops):
@@ -169,35 +763,6 @@ def _get_instructions_size(ops):
     return size
 
 
-def _write_instruction(buf, pos, opname, oparg=0):
-    # Python 3.11 and above are special, no more absolute jumps.
-    if opname == 'JUMP_ABSOLUTE' and _BYTECODE.relative_jumps_only:
-        # TODO: Our offset calculation is definitely not right.
-        jump_relative_point = pos + 2
-        jump_target = oparg * _BYTECODE.jump_unit
-        if jump_relative_point >= jump_target:
-            opname = 'JUMP_BACKWARD'
-            oparg = jump_relative_point - jump_target
-        else:
-            opname = 'JUMP_FORWARD'
-            oparg = jump_target - jump_relative_point
-
-    extended_arg = oparg >> _BYTECODE.argument_bits
-    if extended_arg != 0:
-        pos = _write_instruction(buf, pos, 'EXTENDED_ARG', extended_arg)
-        oparg &= (1 << _BYTECODE.argument_bits) - 1
-
-    opcode = dis.opmap[opname]
-    buf[pos] = opcode
-    pos += 1
-
-    if opcode >= _BYTECODE.have_argument:
-        _BYTECODE.argument.pack_into(buf, pos, oparg)
-        pos += _BYTECODE.argument.size
-
-    return pos
-
-
 def _write_instructions(buf, pos, ops):
     for op in ops:
         if isinstance(op, str):
@@ -212,96 +777,128 @@ def _warn_bug(msg):
                   + " - result of with_goto may be incorrect. (%s)" % msg)
 
 
-def _find_labels_and_gotos(code):
+class _Block(object):
+    # An entry of the block stack, linked to the block below it. A stack is
+    # represented by its innermost block, so pushing doesn't affect stacks
+    # saved before. Blocks are compared by identity, and their type may be
+    # changed once we know more about them.
+    __slots__ = ['type', 'target', 'parent', 'depth']
+
+    def __init__(self, type, target, parent):
+        self.type = type
+        self.target = target
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent is not None else 0
+
+    def blocks_until(self, ancestor):
+        # yields the blocks from this one outwards, until (excluding) ancestor
+        block = self
+        while block is not ancestor:
+            yield block
+            block = block.parent
+
+    def common_ancestor(self, other):
+        block = self
+        while block.depth > other.depth:
+            block = block.parent
+        while other.depth > block.depth:
+            other = other.parent
+        while block is not other:
+            block = block.parent
+            other = other.parent
+        return block
+
+
+def _find_labels_and_gotos(code, instructions=None):
     labels = {}
     gotos = []
 
-    block_stack = []
-    block_counter = 0
+    # the innermost block; stacks saved for labels and gotos are just
+    # references to it, sharing their outer blocks with each other
+    block_stack = _Block(None, None, None)
     last_block = None
 
-    opname1 = oparg1 = offset1 = None
-    opname2 = oparg2 = offset2 = None
-    opname3 = oparg3 = offset3 = None
-
-    def replace_block_in_stack(stack, old_block, new_block):
-        for i, block in enumerate(stack):
-            if block == old_block:
-                stack[i] = new_block
-
-    def replace_block(old_block, new_block):
-        replace_block_in_stack(block_stack, old_block, new_block)
-        for label_target in labels:
-            replace_block_in_stack(labels[label_target][2], old_block, new_block)
-        for g in gotos:
-            replace_block_in_stack(g[3], old_block, new_block)
-
     def push_block(opname, target_offset=None):
-        new_counter = block_counter + 1
-        block_stack.append((opname, target_offset, new_counter))
-        return new_counter  # to be assigned to block_counter
+        return _Block(opname, target_offset, block_stack)
 
     def pop_block():
-        if block_stack:
-            return block_stack.pop()
+        if block_stack.parent is not None:
+            return block_stack.parent, block_stack
         else:
             _warn_bug("can't pop block")
+            return block_stack, None
 
     def pop_block_of_type(typ):
-        if block_stack and block_stack[-1][0] != typ:
+        if block_stack.parent is not None and block_stack.type != typ:
             # in 3.8, only finally blocks are supported, so we must determine
-            # except/finally ourselves, and replace the block's type
+            # except/finally ourselves, and retype the block
             if not _BYTECODE.has_setup_except and \
                     typ == "<EXCEPT>" and \
-                    block_stack[-1][0] == '<FINALLY>':
-                replace_block(block_stack[-1], (typ,) + block_stack[-1][1:])
+                    block_stack.type == '<FINALLY>':
+                block_stack.type = typ
             else:
                 _warn_bug("mismatched block type")
         return pop_block()
 
-    jump_targets = set(dis.findlabels(code.co_code))
+    if instructions is None:
+        instructions = _Instructions(code.co_code)
+    opcodes = instructions.opcodes
+    args = instructions.args
+    offsets = instructions.offsets
+    opnames = dis.opname
+    scanned_ops = _BYTECODE.scanned_ops
+
+    jump_targets, indices = instructions.scan()
     dead = False
 
-    for opname4, oparg4, offset4 in _parse_instructions(code.co_code, 3):
-        endoffset1 = offset2
+    for i in indices:
+        offset1 = offsets[i]
 
         if offset1 in jump_targets:
             dead = False
 
         # check for block exits
-        while block_stack and offset1 == block_stack[-1][1]:
-            exitname, _, _ = last_block = pop_block()
+        while block_stack.parent is not None and offset1 == block_stack.target:
+            block_stack, last_block = pop_block()
+            exitname = last_block.type
 
             if exitname == 'SETUP_EXCEPT' and _BYTECODE.has_pop_except:
-                block_counter = push_block('<EXCEPT>')
+                block_stack = push_block('<EXCEPT>')
             elif exitname == 'SETUP_FINALLY':
-                block_counter = push_block('<FINALLY>')
+                block_stack = push_block('<FINALLY>')
+
+        if opcodes[i] not in scanned_ops:
+            continue
+        opname1 = opnames[opcodes[i]]
 
         # check for special opcodes
         if opname1 in ('LOAD_GLOBAL', 'LOAD_NAME'):
+            opname2 = opnames[opcodes[i + 1]]
+            opname3 = opnames[opcodes[i + 2]]
             if opname2 == 'LOAD_ATTR' and opname3 == 'POP_TOP':
-                name = _get_name(code, oparg1)
+                name = _get_name(code, opcodes[i], args[i])
                 if name == 'label':
-                    if oparg2 in labels:
-                        co_name = _get_name(code, oparg2)
-                        raise SyntaxError('Ambiguous label {0!r}'.format(co_name))
-                    labels[oparg2] = (offset1,
-                                      offset4,
-                                      list(block_stack))
+                    target = _get_name(code, opcodes[i + 1], args[i + 1])
+                    if target in labels:
+                        raise SyntaxError('Ambiguous label {0!r}'.format(target))
+                    labels[target] = (offset1,
+                                      offsets[i + 3],
+                                      block_stack)
                 elif name == 'goto':
                     gotos.append((offset1,
-                                  offset4,
-                                  oparg2,
-                                  list(block_stack),
+                                  offsets[i + 3],
+                                  _get_name(code, opcodes[i + 1], args[i + 1]),
+                                  block_stack,
                                   0))
             elif opname2 == 'LOAD_ATTR' and opname3 == 'STORE_ATTR':
-                if _get_name(code, oparg1) == 'goto' and \
-                        _get_name(code, oparg2) in ('param', 'params'):
-                    gotos.append((offset1,
-                                  offset4,
-                                  oparg3,
-                                  list(block_stack),
-                                  _get_name(code, oparg2)))
+                if _get_name(code, opcodes[i], args[i]) == 'goto':
+                    params = _get_name(code, opcodes[i + 1], args[i + 1])
+                    if params in ('param', 'params'):
+                        gotos.append((offset1,
+                                      offsets[i + 3],
+                                      _get_name(code, opcodes[i + 2], args[i + 2]),
+                                      block_stack,
+                                      params))
 
         elif opname1 in ('SETUP_LOOP', 'FOR_ITER',
                          'SETUP_EXCEPT', 'SETUP_FINALLY',
@@ -309,22 +906,22 @@ def _find_labels_and_gotos(code):
             if opname1 == 'SETUP_FINALLY' and sys.version_info >= (3, 9):
                 raise NotImplementedError("finally semantics not supported in 3.9+")
             # Make sure to convert the argument to the real offset using the given version's jump units
-            block_counter = push_block(opname1, endoffset1 + (oparg1 * _BYTECODE.jump_unit))
+            block_stack = push_block(opname1, offsets[i + 1] + (args[i] * _BYTECODE.jump_unit))
 
         elif opname1 == 'POP_EXCEPT':
-            last_block = pop_block_of_type('<EXCEPT>')
+            block_stack, last_block = pop_block_of_type('<EXCEPT>')
 
         elif opname1 == 'END_FINALLY' and not dead:
             # (python compilers put dead END_FINALLY's in weird places)
-            last_block = pop_block_of_type('<FINALLY>')
+            block_stack, last_block = pop_block_of_type('<FINALLY>')
 
         elif opname1 in ('WITH_CLEANUP', 'WITH_CLEANUP_START'):
             if _BYTECODE.has_setup_with:
                 # temporary block to match END_FINALLY
-                block_counter = push_block('<FINALLY>')
+                block_stack = push_block('<FINALLY>')
             else:
                 # python 2.6 - finally was actually with
-                replace_block(last_block, ('SETUP_WITH',) + last_block[1:])
+                last_block.type = 'SETUP_WITH'
 
         elif opname1 == 'WITH_EXCEPT_START':
             # Python 3.9+
@@ -334,19 +931,19 @@ def _find_labels_and_gotos(code):
         if opname1 in ('JUMP_ABSOLUTE', 'JUMP_FORWARD'):
             dead = True
 
-        opname1, oparg1, offset1 = opname2, oparg2, offset2
-        opname2, oparg2, offset2 = opname3, oparg3, offset3
-        opname3, oparg3, offset3 = opname4, oparg4, offset4
-
-    if block_stack:
+    if block_stack.parent is not None:
         _warn_bug("block stack not empty")
 
     return labels, gotos
 
 
 def _inject_nop_sled(buf, pos, end):
-    while pos < end:
-        pos = _write_instruction(buf, pos, 'NOP')
+    _BYTECODE.write_nops(buf, pos, end)
+
+
+class _SiteTooSmall(Exception):
+    # not even a jump to the end of the code fits into a goto's site
+    pass
 
 
 def _inject_ops(buf, pos, end, ops):
@@ -359,8 +956,9 @@ def _inject_ops(buf, pos, end, ops):
         go_to_end_ops = [('JUMP_ABSOLUTE', buf_end // _BYTECODE.jump_unit)]
 
         if pos + _get_instructions_size(go_to_end_ops) > end:
-            # not sure if reachable
-            raise SyntaxError('Goto in an incredibly huge function')
+            # only in incredibly huge functions, where the jump needs more
+            # EXTENDED_ARGs than the site has
+            raise _SiteTooSmall()
 
         pos = _write_instructions(buf, pos, go_to_end_ops)
         _inject_nop_sled(buf, pos, end)
@@ -372,120 +970,496 @@ def _inject_ops(buf, pos, end, ops):
         _inject_nop_sled(buf, pos, end)
 
 
+def _const_key(value):
+    # Constants that compare equal aren't necessarily interchangeable, e.g.
+    # 1, 1.0 and True, or 0.0 and -0.0 (and NaN isn't even equal to itself),
+    # so the type is part of the key and floats are keyed by their repr.
+    # Code objects (which compare by value) and unhashable constants are
+    # keyed by identity.
+    if isinstance(value, (float, complex)):
+        return type(value), repr(value)
+    if isinstance(value, tuple):
+        return tuple, tuple(_const_key(item) for item in value)
+    if isinstance(value, frozenset):
+        return frozenset, frozenset(_const_key(item) for item in value)
+    if isinstance(value, types.CodeType):
+        return types.CodeType, id(value)
+    try:
+        hash(value)
+    except TypeError:
+        return type(value), id(value)
+    return type(value), value
+
+
+class _Identity(object):
+    # compares and hashes by the identity of the wrapped value, which it
+    # keeps alive (so its id isn't reused while e.g. a cache key holds it)
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return isinstance(other, _Identity) and self.value is other.value
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return id(self.value)
+
+
+# types of constants that marshal loads back as interchangeable objects
+_PLAIN_CONST_TYPES = frozenset((
+    type(None), bool, int, float, complex, bytes, str, type(u''),
+    type(2 ** 64),  # long on PY2
+))
+
+
+def _is_plain_const(value):
+    if type(value) in (tuple, frozenset):
+        return all(_is_plain_const(item) for item in value)
+    return type(value) in _PLAIN_CONST_TYPES
+
+
 class _CodeData:
+    # The consts, names and varnames of a code object being patched. They
+    # are kept in lists, with dicts mapping consts and names to their
+    # index, and converted to tuples by _make_code.
     def __init__(self, code):
         self.nlocals = code.co_nlocals
-        self.varnames = code.co_varnames
-        self.consts = code.co_consts
-        self.names = code.co_names
+        self.varnames = list(code.co_varnames)
+        self.consts = list(code.co_consts)
+        self.names = list(code.co_names)
+        self._const_indices = {}
+        for i, value in enumerate(self.consts):
+            self._const_indices.setdefault(_const_key(value), i)
+        self._injected_indices = {}
+        self._name_indices = {}
+        for i, name in enumerate(self.names):
+            self._name_indices.setdefault(name, i)
 
     def get_const(self, value):
+        key = _const_key(value)
+        try:
+            return self._const_indices[key]
+        except KeyError:
+            i = self._const_indices[key] = len(self.consts)
+            self.consts.append(value)
+            return i
+
+    def get_injected_const(self, value):
+        # for values that don't come from the code (e.g. bound globals):
+        # these must load the very same object, so they are keyed by
+        # identity (consts keeps them alive, so their ids aren't reused)
         try:
-            i = self.consts.index(value)
-        except ValueError:
-            i = len(self.consts)
-            self.consts += (value,)
-        return i
+            return self._injected_indices[id(value)]
+        except KeyError:
+            i = self._injected_indices[id(value)] = len(self.consts)
+            self.consts.append(value)
+            return i
 
     def get_name(self, value):
         try:
-            i = self.names.index(value)
-        except ValueError:
-            i = len(self.names)
-            self.names += (value,)
-        return i
+            return self._name_indices[value]
+        except KeyError:
+            i = self._name_indices[value] = len(self.names)
+            self.names.append(value)
+            return i
 
     def add_var(self, name):
         idx = len(self.varnames)
-        self.varnames += (name,)
+        self.varnames.append(name)
         self.nlocals += 1
         return idx
 
 
-def _patch_code(code):
-    new_code = _patched_code_cache.get(code)
-    if new_code is not None:
+# how code is patched, see with_goto()
+# (constants is a sorted tuple of (name, value) pairs)
+_Options = collections.namedtuple(
+    'Options', 'compact thread_jumps remove_dead_code constants')
+_DEFAULT_OPTIONS = _Options(compact=False, thread_jumps=False,
+                            remove_dead_code=False, constants=())
+
+
+class _Flight(object):
+    # a patch in progress, which other threads wait for
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def _patch_code(code, options=_DEFAULT_OPTIONS):
+    if _PATCHED_MARKER in code.co_names:
+        if options != _DEFAULT_OPTIONS:
+            raise ValueError("code is already patched, "
+                             "options can't be applied to it")
+        return code
+
+    global _cache_hits
+
+    # reads of the identity cache (keyed by id(), as equal code objects may
+    # still differ in e.g. co_filename) don't lock (hits may be miscounted
+    # when racing, which is all the statistics are for); it only holds code
+    # patched with the default options
+    default = options == _DEFAULT_OPTIONS
+    if default:
+        new_code = _patched_code_cache.get(code)
+        if new_code is not None:
+            _cache_hits += 1
+            return new_code
+
+    # only one thread patches code with a given digest, others wait for it
+    digest = _code_digest(code)
+    # (constants are loaded as the very same objects, so they are keyed by
+    # identity; they need not be hashable either)
+    key = digest if default else (digest, options._replace(constants=tuple(
+        (name, _Identity(value)) for name, value in options.constants)))
+    with _flights_lock:
+        new_code = _content_cache.get(key)
+        flight = None
+        if new_code is None:
+            flight = _flights.get(key)
+            if flight is None:
+                owner = _flights[key] = _Flight()
+    if new_code is not None or flight is not None:
+        if flight is not None:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            new_code = flight.result
+        _cache_hits += 1
+        if default:
+            _patched_code_cache[code] = new_code
         return new_code
 
-    labels, gotos = _find_labels_and_gotos(code)
-    buf = array.array('B', code.co_code)
-    temp_var = None
-    many_params = False
+    try:
+        new_code = owner.result = _load_or_rewrite_code(code, digest, options)
+        if default:
+            _patched_code_cache[code] = new_code
+        _content_cache[key] = new_code
+    except BaseException as e:
+        owner.error = e
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        owner.done.set()
+    return new_code
 
-    data = _CodeData(code)
 
-    for pos, end, _ in labels.values():
-        _inject_nop_sled(buf, pos, end)
+def _load_or_rewrite_code(code, digest, options=_DEFAULT_OPTIONS):
+    global _cache_hits, _cache_misses
+
+    if _cache_dir is None or \
+            not all(_is_plain_const(value) for _, value in options.constants):
+        # (other constants would be loaded from it as copies)
+        cache_path = None
+    else:
+        cache_path = _disk_cache_path(digest, options)
+        new_code = _read_disk_cache(cache_path)
+        if new_code is not None:
+            _cache_hits += 1
+            return new_code
+
+    _cache_misses += 1
+    new_code = _rewrite_code(code, options)
+    if cache_path is not None:
+        _write_disk_cache(cache_path, new_code)
+    return new_code
+
+
+def _fold_constants(code, instructions, buf, data, constants):
+    # Replaces loads of the global names in constants with LOAD_CONST of
+    # their value. Where such a load is the condition of a POP_JUMP_IF_*,
+    # the branch is decided now: the load is dropped, and the jump either
+    # becomes a JUMP_ABSOLUTE (written to buf right away, as it has the same
+    # size) or is dropped too. The decoded instructions are updated to
+    # match, so the other passes see plain jumps. Returns the ops for the
+    # replaced and dropped instructions like _rewrite_code builds them for
+    # gotos.
+    if _BYTECODE.cache_opcode is not None:
+        raise NotImplementedError('constants are not supported in Python 3.11+')
+
+    opmap = dis.opmap
+    load_ops = (opmap['LOAD_GLOBAL'], opmap['LOAD_NAME'])
+    branches = {}
+    if opmap.get('POP_JUMP_IF_FALSE') in _BYTECODE.hasjabs:
+        # opcode -> the value of the condition for which it jumps
+        branches = {opmap['POP_JUMP_IF_FALSE']: False,
+                    opmap['POP_JUMP_IF_TRUE']: True}
+    nop = opmap['NOP']
+    opcodes = instructions.opcodes
+    args = instructions.args
+    offsets = instructions.offsets
+    jump_targets = instructions.jump_targets()
+
+    ops = []
+    for i in range(instructions.count):
+        if opcodes[i] not in load_ops:
+            continue
+        name = _get_name(code, opcodes[i], args[i])
+        if name not in constants or name in _GOTO_NAMES:
+            continue
+        value = constants[name]
+        pos = offsets[i]
+        end = offsets[i + 1]
+
+        branch = branches.get(opcodes[i + 1])
+        if branch is not None and end not in jump_targets:
+            opcodes[i] = nop
+            ops.append((pos, end, ()))
+            if bool(value) == branch:
+                opcodes[i + 1] = opmap['JUMP_ABSOLUTE']
+                _write_instruction(buf, end, 'JUMP_ABSOLUTE', args[i + 1])
+            else:
+                opcodes[i + 1] = nop
+                ops.append((end, offsets[i + 2], ()))
+            continue
+
+        # (in the rare case the index of the constant needs more
+        # EXTENDED_ARGs than the name, the load is left as is)
+        const = data.get_injected_const(value)
+        load = [('LOAD_CONST', const)]
+        if pos + _get_instructions_size(load) <= end:
+            opcodes[i] = opmap['LOAD_CONST']
+            args[i] = const
+            ops.append((pos, end, load))
+    return ops
+
+
+def _thread_jumps(instructions, labels, gotos, compact):
+    # Retargets gotos, and jumps to labels or gotos, to the last label of a
+    # chain of labels and gotos, e.g. `goto .a` where `label .a` is followed
+    # by `goto .b`. Every goto followed must take no params and only pop
+    # blocks, so that skipping it only skips popping these blocks, which the
+    # retargeted goto does instead. Jumps (including conditional ones) are
+    # only retargeted where the chain doesn't change the block stack at all.
+    # With compact, `if x: goto .a` becomes a single inverted conditional
+    # jump (in place, the fall-through path would run the goto's NOP sled
+    # instead). Returns the new gotos, and the ops for the retargeted jumps
+    # like _rewrite_code builds them for gotos.
+    unit = _BYTECODE.jump_unit
+    label_at = dict((pos, name) for name, (pos, _, _) in labels.items())
+    goto_at = dict((goto[0], goto) for goto in gotos)
+
+    def follow(name):
+        seen = set()
+        while name not in seen:
+            seen.add(name)
+            _, end, stack = labels[name]
+            if end in label_at:
+                next_name = label_at[end]
+            elif end in goto_at:
+                _, _, next_name, origin_stack, params = goto_at[end]
+                if params or next_name not in labels or \
+                        origin_stack.common_ancestor(labels[next_name][2]) is not \
+                        labels[next_name][2]:
+                    break
+            else:
+                break
+            if next_name in seen:
+                break
+            name = next_name
+        return name
+
+    new_gotos = []
+    for goto in gotos:
+        pos, end, name, origin_stack, params = goto
+        if not params and name in labels:
+            goto = (pos, end, follow(name), origin_stack, params)
+        new_gotos.append(goto)
+    goto_at = dict((goto[0], goto) for goto in new_gotos)
+
+    def final_target(offset):
+        # the end of the label a jump to offset can go to instead, or None
+        if offset in label_at:
+            name = label_at[offset]
+            stack = labels[name][2]
+        elif offset in goto_at:
+            _, _, name, stack, params = goto_at[offset]
+            if params or name not in labels:
+                return None
+        else:
+            return None
+        name = follow(name)
+        if labels[name][2] is not stack:
+            return None
+        return labels[name][1]
+
+    def fits_in_place(pos, end, ops):
+        return compact or pos + _get_instructions_size(ops) <= end
+
+    jump_targets = instructions.jump_targets()
+    opcodes = instructions.opcodes
+    args = instructions.args
+    offsets = instructions.offsets
+    opmap = dis.opmap
+    conditional = {}
+    if opmap.get('POP_JUMP_IF_FALSE') in _BYTECODE.hasjabs:
+        conditional = {opmap['POP_JUMP_IF_FALSE']: 'POP_JUMP_IF_TRUE',
+                       opmap['POP_JUMP_IF_TRUE']: 'POP_JUMP_IF_FALSE'}
+    inverted = conditional if compact else {}
+    jumps = set(conditional)
+    for opname in ('JUMP_ABSOLUTE', 'JUMP_FORWARD'):
+        if opname in opmap:
+            jumps.add(opmap[opname])
+
+    jump_ops = []
+    removed = set()
+    for i in range(instructions.count):
+        opcode = opcodes[i]
+        if opcode not in jumps:
+            continue
+        if opcode in _BYTECODE.hasjabs:
+            target = args[i] * unit
+        else:
+            target = offsets[i + 1] + args[i] * unit
+        pos = offsets[i]
+        end = offsets[i + 1]
+
+        # `if x: goto .a`, i.e. a conditional jump over a goto
+        goto = goto_at.get(end)
+        if opcode in inverted and goto is not None and goto[1] == target \
+                and end not in jump_targets:
+            new_target = final_target(end)
+            if new_target is not None:
+                jump_ops.append((pos, goto[1], [(inverted[opcode], new_target // unit)]))
+                removed.add(end)
+                continue
+
+        new_target = final_target(target)
+        if new_target is not None and new_target != target:
+            opname = dis.opname[opcode]
+            if opname == 'JUMP_FORWARD':
+                opname = 'JUMP_ABSOLUTE'
+            ops = [(opname, new_target // unit)]
+            if fits_in_place(pos, end, ops):
+                jump_ops.append((pos, end, ops))
+
+    new_gotos = [goto for goto in new_gotos if goto[0] not in removed]
+    return new_gotos, jump_ops
+
+
+# blocks that take a param of a goto jumping into them
+_PARAM_BLOCKS = ('FOR_ITER', 'SETUP_WITH', 'SETUP_ASYNC_WITH')
+
+
+def _rewrite_code(code, options=_DEFAULT_OPTIONS):
+    instructions = _Instructions(code.co_code)
+    buf = array.array('B', code.co_code)
+    data = _CodeData(code)
+    goto_ops = []
+    if options.constants:
+        goto_ops.extend(_fold_constants(code, instructions, buf, data,
+                                        dict(options.constants)))
+    labels, gotos = _find_labels_and_gotos(code, instructions)
+    # removing dead code needs the assembler as well
+    compact = options.compact or options.remove_dead_code
+    if options.thread_jumps:
+        gotos, jump_ops = _thread_jumps(instructions, labels, gotos, compact)
+        goto_ops.extend(jump_ops)
+    # hidden locals holding the params of gotos until the blocks taking
+    # them are pushed, one per block
+    temp_vars = []
+
+    pop_block_ops = _BYTECODE.pop_block_ops
+    default_pop_ops = ('POP_BLOCK',)
+
+    def resolve_none(ops):
+        return [('LOAD_CONST', data.get_const(None)) if op is _LOAD_NONE else op
+                for op in ops]
 
     for pos, end, label_target, origin_stack, params in gotos:
         try:
             _, target, target_stack = labels[label_target]
         except KeyError:
-            raise SyntaxError('Unknown label {0!r}'.format(_get_name(code, label_target)))
+            raise SyntaxError('Unknown label {0!r}'.format(label_target))
 
         ops = []
 
         # prepare
-        common_depth = min(len(origin_stack), len(target_stack))
-        for i in range(common_depth):
-            if origin_stack[i] != target_stack[i]:
-                common_depth = i
-                break
-
+        common_block = origin_stack.common_ancestor(target_stack)
+        blocks_to_pop = list(origin_stack.blocks_until(common_block))
+        blocks_to_push = list(target_stack.blocks_until(common_block))
+        blocks_to_push.reverse()
+        n_params = sum(1 for block in blocks_to_push
+                       if block.type in _PARAM_BLOCKS)
+
+        # the only param can stay on the stack if it's taken by the first
+        # block pushed, otherwise params are stored in hidden locals, which
+        # must be done before any blocks are pushed/popped; several values
+        # of goto.params are unpacked into them once the blocks are popped,
+        # so the stack doesn't grow beyond what the code needs anyway
+        direct = False
+        unpack_ops = []
         if params:
-            if temp_var is None:
-                temp_var = data.add_var('goto.temp')
-
-            # must do this before any blocks are pushed/popped
-            ops.append(('STORE_FAST', temp_var))
-            many_params = (params != 'param')
-
-        # pop blocks
-        for block, _, _ in reversed(origin_stack[common_depth:]):
-            if block == 'FOR_ITER':
-                if not _BYTECODE.has_loop_blocks:
-                    ops.append('POP_TOP')
-            elif block == '<EXCEPT>':
-                ops.append('POP_EXCEPT')
-            elif block == '<FINALLY>':
-                ops.append('END_FINALLY')
+            if n_params == 0:
+                ops.append('POP_TOP')
+            elif n_params == 1 and not blocks_to_pop and \
+                    blocks_to_push[0].type in _PARAM_BLOCKS:
+                direct = True
+                if params != 'param':
+                    ops.append(('LOAD_CONST', data.get_const(0)))
+                    ops.append('BINARY_SUBSCR')
             else:
-                ops.append('POP_BLOCK')
-                if block in ('SETUP_WITH', 'SETUP_ASYNC_WITH'):
-                    ops.append('POP_TOP')
-                # pypy 3.6 keeps a block around until END_FINALLY;
-                # python 3.8 reuses SETUP_FINALLY for SETUP_EXCEPT
-                # (where END_FINALLY is not accepted).
-                # What will pypy 3.8 do?
-                if _BYTECODE.pypy_finally_semantics and \
-                        block in ('SETUP_FINALLY', 'SETUP_WITH',
-                                  'SETUP_ASYNC_WITH'):
-                    if _BYTECODE.has_begin_finally:
-                        ops.append('BEGIN_FINALLY')
+                if params == 'param':
+                    n_params = 1
+                while len(temp_vars) < n_params:
+                    temp_vars.append(data.add_var(
+                        'goto.temp%d' % len(temp_vars) if temp_vars
+                        else 'goto.temp'))
+                ops.append(('STORE_FAST', temp_vars[0]))
+                # goto.params must be a sequence, and values beyond those
+                # taken by blocks are ignored
+                if params != 'param':
+                    unpack_ops.append(('LOAD_FAST', temp_vars[0]))
+                    if n_params == 1:
+                        unpack_ops.append(('LOAD_CONST', data.get_const(0)))
+                        unpack_ops.append('BINARY_SUBSCR')
                     else:
-                        ops.append(('LOAD_CONST', data.get_const(None)))
-                    ops.append('END_FINALLY')
+                        unpack_ops.append(('LOAD_CONST', data.get_const(None)))
+                        unpack_ops.append(('LOAD_CONST', data.get_const(n_params)))
+                        unpack_ops.append(('BUILD_SLICE', 2))
+                        unpack_ops.append('BINARY_SUBSCR')
+                        unpack_ops.append(('UNPACK_SEQUENCE', n_params))
+                    for temp_var in temp_vars[:n_params]:
+                        unpack_ops.append(('STORE_FAST', temp_var))
+
+        # pop blocks
+        for block in blocks_to_pop:
+            pop_ops = pop_block_ops.get(block.type, default_pop_ops)
+            if _LOAD_NONE in pop_ops:
+                pop_ops = resolve_none(pop_ops)
+            ops.extend(pop_ops)
+        ops.extend(unpack_ops)
 
         # push blocks
         def setup_block_absolute(block_offset, block_end):
             # there's no SETUP_*_ABSOLUTE, so we setup forward to an JUMP_ABSOLUTE
-            jump_abs_op = ('JUMP_ABSOLUTE', block_end)
-            skip_jump_op = ('JUMP_FORWARD', _get_instruction_size(*jump_abs_op))
-            setup_block_op = (block_offset, _get_instruction_size(*skip_jump_op))
+            unit = _BYTECODE.jump_unit
+            jump_abs_op = ('JUMP_ABSOLUTE', block_end // unit)
+            skip_jump_op = ('JUMP_FORWARD', _get_instruction_size(*jump_abs_op) // unit)
+            setup_block_op = (block_offset, _get_instruction_size(*skip_jump_op) // unit)
             ops.extend((setup_block_op, skip_jump_op, jump_abs_op))
 
         tuple_i = 0
-        for block, block_target, _ in target_stack[common_depth:]:
-            if block in ('FOR_ITER', 'SETUP_WITH', 'SETUP_ASYNC_WITH'):
+        for block in blocks_to_push:
+            block, block_target = block.type, block.target
+            if block in _PARAM_BLOCKS:
                 if not params:
                     raise SyntaxError(
                         'Jump into block without the necessary params')
 
-                ops.append(('LOAD_FAST', temp_var))
-                if many_params:
-                    ops.append(('LOAD_CONST', data.get_const(tuple_i)))
-                    ops.append('BINARY_SUBSCR')
-                tuple_i += 1
+                if not direct:
+                    ops.append(('LOAD_FAST', temp_vars[tuple_i]))
+                if params != 'param':
+                    tuple_i += 1
 
                 if block == 'FOR_ITER':
                     # this both converts iterables to iterators for
@@ -504,22 +1478,15 @@ def _patch_code(code):
                 setup_block_absolute(block, block_target)
 
             elif block == '<FINALLY>':
-                if _BYTECODE.pypy_finally_semantics:
-                    ops.append('SETUP_FINALLY')
-                    ops.append('POP_BLOCK')
-                if _BYTECODE.has_begin_finally:
-                    ops.append('BEGIN_FINALLY')
-                else:
-                    ops.append(('LOAD_CONST', data.get_const(None)))
+                ops.extend(resolve_none(_BYTECODE.push_finally_ops))
 
             elif block == '<EXCEPT>':
                 # we raise an exception to get the right block pushed
                 raise_ops = [('LOAD_CONST', data.get_const(None)),
                              ('RAISE_VARARGS', 1)]
 
-                setup_except = 'SETUP_EXCEPT' if _BYTECODE.has_setup_except else \
-                    'SETUP_FINALLY'
-                ops.append((setup_except, _get_instructions_size(raise_ops)))
+                ops.append((_BYTECODE.setup_except,
+                            _get_instructions_size(raise_ops) // _BYTECODE.jump_unit))
                 ops += raise_ops
                 for _ in range(3):
                     ops.append("POP_TOP")
@@ -528,29 +1495,1107 @@ def _patch_code(code):
                 _warn_bug("ignoring %s" % block)
 
         ops.append(('JUMP_ABSOLUTE', target // _BYTECODE.jump_unit))
+        goto_ops.append((pos, end, ops))
 
-        _inject_ops(buf, pos, end, ops)
+    data.get_name(_PATCHED_MARKER)
+    if compact:
+        return _assemble(code, instructions, data, labels, goto_ops,
+                         options.remove_dead_code)
 
-    new_code = _make_code(code, _array_to_bytes(buf), data)
+    for pos, end, _ in labels.values():
+        _inject_nop_sled(buf, pos, end)
+    try:
+        for pos, end, ops in goto_ops:
+            _inject_ops(buf, pos, end, ops)
+    except _SiteTooSmall:
+        # the assembler has no such limits
+        return _assemble(code, instructions, data, labels, goto_ops)
+    return _make_code(code, _array_to_bytes(buf), data)
+
+
+def _assemble(code, instructions, data, labels, goto_ops,
+              remove_dead_code=False):
+    # Writes the patched code from scratch, rather than overwriting label and
+    # goto sites in place: labels are dropped and the ops of each goto are
+    # placed inline. Jumps refer to the index of their target instruction
+    # until the final layout is known, then the line numbers are relocated.
+    # With remove_dead_code, instructions that can't be reached from the
+    # start of the code (e.g. after a goto) are dropped as well.
+    if _BYTECODE.cache_opcode is not None:
+        raise NotImplementedError('compact=True is not supported in Python 3.11+')
+
+    unit = _BYTECODE.jump_unit
+    hasjrel = _BYTECODE.hasjrel
+    hasjabs = _BYTECODE.hasjabs
+    backward_jumps = _BYTECODE.backward_jumps
+    opcodes = instructions.opcodes
+    args = instructions.args
+    offsets = instructions.offsets
+    count = instructions.count
+    index_of = dict((offsets[i], i) for i in range(count + 1))
+
+    # start index of each site -> (end index, ops to put there)
+    sites = {}
+    for pos, end, _ in labels.values():
+        sites[index_of[pos]] = (index_of[end], ())
+    for pos, end, ops in goto_ops:
+        sites[index_of[pos]] = (index_of[end], ops)
+
+    # index of the first new instruction for each original one
+    first_item = [0] * (count + 1)
+    n = i = 0
+    while i < count:
+        site = sites.get(i)
+        if site is None:
+            first_item[i] = n
+            n += 1
+            i += 1
+        else:
+            end, ops = site
+            for k in range(i, end):
+                first_item[k] = n
+            n += len(ops)
+            i = end
+    first_item[count] = n
+
+    # the new instructions, with the index of their target for jumps
+    opnames = []
+    opargs = []
+    targets = []
+    i = 0
+    while i < count:
+        site = sites.get(i)
+        if site is None:
+            opcode = opcodes[i]
+            target = None
+            if opcode in hasjrel:
+                if opcode in backward_jumps:
+                    target = offsets[i + 1] - args[i] * unit
+                else:
+                    target = offsets[i + 1] + args[i] * unit
+            elif opcode in hasjabs:
+                target = args[i] * unit
+            opnames.append(dis.opname[opcode])
+            opargs.append(args[i])
+            targets.append(None if target is None else first_item[index_of[target]])
+            i += 1
+            continue
 
-    _patched_code_cache[code] = new_code
-    return new_code
+        # the ops of a goto are written for a contiguous layout, with relative
+        # jumps within them and absolute jumps into the original code
+        end, ops = site
+        ops = [(op, 0) if isinstance(op, str) else op for op in ops]
+        local_items = {}
+        pos = 0
+        for k, (opname, oparg) in enumerate(ops):
+            local_items[pos] = len(opnames) + k
+            pos += _get_instruction_size(opname, oparg)
+        local_items[pos] = len(opnames) + len(ops)
+
+        pos = 0
+        for opname, oparg in ops:
+            pos += _get_instruction_size(opname, oparg)
+            opcode = dis.opmap[opname]
+            target = None
+            if opcode in hasjabs:
+                target = first_item[index_of[oparg * unit]]
+            elif opcode in hasjrel:
+                target = local_items[pos + oparg * unit]
+            opnames.append(opname)
+            opargs.append(oparg)
+            targets.append(target)
+        i = end
+
+    if remove_dead_code:
+        _remove_dead_code(opnames, opargs, targets, first_item)
+
+    # jumps may need EXTENDED_ARGs once their targets move further away,
+    # which moves other targets; sizes only grow, so repeat until they settle
+    n = len(opnames)
+    sizes = [_get_instruction_size(opnames[k], 0 if targets[k] is not None else opargs[k])
+             for k in range(n)]
+    jumps = [k for k in range(n) if targets[k] is not None]
+    while True:
+        positions = [0] * (n + 1)
+        pos = 0
+        for k in range(n):
+            positions[k] = pos
+            pos += sizes[k]
+        positions[n] = pos
+
+        changed = False
+        for k in jumps:
+            opname = opnames[k]
+            target = positions[targets[k]]
+            opcode = dis.opmap[opname]
+            if opcode in hasjabs:
+                oparg = target // unit
+            elif opcode in backward_jumps:
+                oparg = (positions[k] + sizes[k] - target) // unit
+            else:
+                oparg = (target - positions[k] - sizes[k]) // unit
+            if oparg < 0:
+                _warn_bug("backward relative jump")
+            opargs[k] = oparg
+            size = _get_instruction_size(opname, oparg)
+            if size != sizes[k]:
+                sizes[k] = size
+                changed = True
+        if not changed:
+            break
+
+    buf = array.array('B', [0]) * positions[n]
+    write = _write_instruction
+    for k in range(n):
+        write(buf, positions[k], opnames[k], opargs[k])
+
+    def new_offset(offset):
+        index = index_of.get(offset)
+        if index is None:
+            return None
+        return positions[first_item[index]]
+
+    if hasattr(code, 'co_linetable'):
+        fields = {'co_linetable': _make_linetable(code, new_offset, positions[n])}
+    else:
+        fields = {'co_lnotab': _make_lnotab(code, new_offset)}
+    return _make_code(code, _array_to_bytes(buf), data, **fields)
+
+
+def _remove_dead_code(opnames, opargs, targets, first_item):
+    # Drops the instructions that aren't reachable from the first one,
+    # following jumps (including the handlers of SETUP_* instructions) and
+    # fall-through, in place, and then jumps to the next kept instruction
+    # (e.g. left by a branch decided by with_goto(constants=...)).
+    # first_item is updated to the index of the next kept instruction.
+    global _dead_code_bytes
+    n = len(opnames)
+    no_fallthrough = _BYTECODE.no_fallthrough
+    reachable = [False] * (n + 1)
+    todo = [0]
+    while todo:
+        k = todo.pop()
+        while k < n and not reachable[k]:
+            reachable[k] = True
+            if targets[k] is not None:
+                todo.append(targets[k])
+            if opnames[k] in no_fallthrough:
+                break
+            k += 1
+
+    keep = list(reachable)
+    # the first kept instruction at or after each index
+    next_kept = [n] * (n + 1)
+    for k in range(n - 1, -1, -1):
+        target = targets[k]
+        if keep[k] and opnames[k] in ('JUMP_ABSOLUTE', 'JUMP_FORWARD') and \
+                target > k and next_kept[target] == next_kept[k + 1]:
+            keep[k] = False
+        next_kept[k] = k if keep[k] else next_kept[k + 1]
+
+    # index of the next kept instruction, for each instruction
+    new_index = [0] * (n + 1)
+    kept = 0
+    for k in range(n):
+        new_index[k] = kept
+        if keep[k]:
+            opnames[kept] = opnames[k]
+            opargs[kept] = opargs[k]
+            targets[kept] = targets[k]
+            kept += 1
+        elif not reachable[k]:
+            _dead_code_bytes += _get_instruction_size(opnames[k], opargs[k])
+    new_index[n] = kept
+    del opnames[kept:], opargs[kept:], targets[kept:]
+
+    for k in range(kept):
+        if targets[k] is not None:
+            targets[k] = new_index[targets[k]]
+    for i in range(len(first_item)):
+        first_item[i] = new_index[first_item[i]]
+
+
+def _relocate_line_starts(line_starts, new_offset):
+    # (offset, line) pairs moved to their new offsets; where several end
+    # up at the same offset (e.g. a dropped label), the last one wins
+    result = []
+    for offset, line in line_starts:
+        offset = new_offset(offset)
+        if offset is None:
+            continue
+        if result and result[-1][0] == offset:
+            result[-1] = (offset, line)
+        else:
+            result.append((offset, line))
+    return result
+
+
+def _iter_lnotab(code, signed):
+    # like dis.findlinestarts(), but also yields entries that don't change
+    # the line, which still make a difference for tracing
+    lnotab = array.array('B', code.co_lnotab)
+    offset = 0
+    line = code.co_firstlineno
+    for i in range(0, len(lnotab), 2):
+        offset_delta, line_delta = lnotab[i], lnotab[i + 1]
+        if offset_delta:
+            yield offset, line
+            offset += offset_delta
+        if signed and line_delta >= 0x80:
+            line_delta -= 0x100
+        line += line_delta
+    yield offset, line
+
+
+def _make_lnotab(code, new_offset):
+    # co_lnotab up to Python 3.9, line deltas are signed as of 3.6
+    signed = sys.version_info >= (3, 6)
+    lnotab = array.array('B')
+    prev_offset = 0
+    prev_line = code.co_firstlineno
+    line_starts = _iter_lnotab(code, signed)
+    for offset, line in _relocate_line_starts(line_starts, new_offset):
+        offset_delta = offset - prev_offset
+        line_delta = line - prev_line
+        if line_delta < 0 and not signed:
+            continue
+        while offset_delta > 255:
+            lnotab.extend((255, 0))
+            offset_delta -= 255
+        line_max = 127 if signed else 255
+        while line_delta > line_max:
+            lnotab.extend((offset_delta, line_max))
+            offset_delta = 0
+            line_delta -= line_max
+        while line_delta < -128:
+            lnotab.extend((offset_delta, 0x80))
+            offset_delta = 0
+            line_delta += 128
+        lnotab.extend((offset_delta, line_delta & 0xff))
+        prev_offset = offset
+        prev_line = line
+    return _array_to_bytes(lnotab)
+
+
+def _make_linetable(code, new_offset, code_size):
+    # co_linetable of Python 3.10, see Objects/lnotab_notes.txt
+    starts = _relocate_line_starts(
+        ((start, line) for start, _, line in code.co_lines()), new_offset)
+    linetable = array.array('B')
+    prev_line = code.co_firstlineno
+    for k, (start, line) in enumerate(starts):
+        end = starts[k + 1][0] if k + 1 < len(starts) else code_size
+        offset_delta = end - start
+        if offset_delta == 0:
+            continue
+        if line is None:
+            line_delta = -128
+        else:
+            line_delta = line - prev_line
+            prev_line = line
+            while line_delta > 127:
+                linetable.extend((0, 127))
+                line_delta -= 127
+            while line_delta < -127:
+                linetable.extend((0, -127 & 0xff))
+                line_delta += 127
+        while offset_delta > 254:
+            linetable.extend((254, line_delta & 0xff))
+            line_delta = -128 if line is None else 0
+            offset_delta -= 254
+        linetable.extend((offset_delta, line_delta & 0xff))
+    return _array_to_bytes(linetable)
+
+
+def _replace_consts(code, consts):
+    data = _CodeData(code)
+    data.consts = consts
+    return _make_code(code, code.co_code, data)
+
+
+def _patch_code_tree(code, should_patch, options=_DEFAULT_OPTIONS):
+    # patches every code object nested in code for which should_patch() is
+    # true, and rebuilds their parents to refer to the patched children
+    consts = list(code.co_consts)
+    changed = False
+    for i, const in enumerate(consts):
+        if isinstance(const, types.CodeType):
+            new_const = _patch_code_tree(const, should_patch, options)
+            if new_const is not const:
+                consts[i] = new_const
+                changed = True
+
+    if should_patch(code):
+        new_code = _patch_code(code, options)
+        if changed:
+            # patching only ever appends constants
+            consts += new_code.co_consts[len(consts):]
+            new_code = _replace_consts(new_code, tuple(consts))
+        return new_code
+    elif changed:
+        return _replace_consts(code, tuple(consts))
+    return code
+
+
+def _bind_globals(options, code, namespace, names, exclude):
+    # Adds the current values of the globals and builtins loaded by code
+    # and its nested code to the constants of options, see with_goto().
+    # Names that any of it assigns or deletes (or goto and label) are left
+    # alone, and so are names that aren't defined yet.
+    builtins_ns = namespace.get('__builtins__', builtins)
+    if isinstance(builtins_ns, types.ModuleType):
+        builtins_ns = vars(builtins_ns)
+
+    loaded = set()
+    assigned = set(_GOTO_NAMES)
+    for nested in _iter_code_tree(code):
+        instructions = _Instructions(nested.co_code)
+        for i in range(instructions.count):
+            opcode = instructions.opcodes[i]
+            opname = dis.opname[opcode]
+            if opname in ('LOAD_GLOBAL', 'LOAD_NAME'):
+                loaded.add(_get_name(nested, opcode, instructions.args[i]))
+            elif opname in ('STORE_GLOBAL', 'DELETE_GLOBAL',
+                            'STORE_NAME', 'DELETE_NAME'):
+                assigned.add(_get_name(nested, opcode, instructions.args[i]))
+    if names is not True:
+        loaded.intersection_update(names)
+    loaded.difference_update(assigned, exclude)
+
+    constants = {}
+    for name in loaded:
+        if name in namespace:
+            constants[name] = namespace[name]
+        elif name in builtins_ns:
+            constants[name] = builtins_ns[name]
+    # explicitly given constants take precedence
+    constants.update(options.constants)
+    return options._replace(constants=tuple(sorted(constants.items())))
+
+
+def _iter_code_tree(code):
+    yield code
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            for nested in _iter_code_tree(const):
+                yield nested
+
+
+def _patch_code_recursive(code, options=_DEFAULT_OPTIONS):
+    # patches code and every code object nested in it that refers to
+    # goto or label, e.g. functions, lambdas and class bodies
+    return _patch_code_tree(
+        code,
+        lambda c: c is code or not _GOTO_NAMES.isdisjoint(c.co_names),
+        options)
+
+
+def _is_with_goto(node):
+    # only bare @with_goto and @with_goto() are patched ahead of time, as
+    # the code is patched with the default options (and marked as patched,
+    # so options given to the decorator couldn't be applied later)
+    import ast
+    if isinstance(node, ast.Call):
+        if node.args or node.keywords or \
+                getattr(node, 'starargs', None) or getattr(node, 'kwargs', None):
+            return False
+        node = node.func
+    if isinstance(node, ast.Name):
+        return node.id == 'with_goto'
+    if isinstance(node, ast.Attribute):
+        return node.attr == 'with_goto'
+    return False
+
+
+def _patch_module_code(code, source):
+    # the first line of a decorated function's code object is either that
+    # of the def or (depending on the version) of its first decorator
+    import ast
+    targets = set()
+    for node in ast.walk(ast.parse(source)):
+        decorators = getattr(node, 'decorator_list', ())
+        if isinstance(node, ast.ClassDef) or \
+                not any(_is_with_goto(d) for d in decorators):
+            continue
+        targets.add((node.name, node.lineno))
+        for decorator in decorators:
+            targets.add((node.name, decorator.lineno))
 
+    code = _patch_code_tree(
+        code, lambda c: (c.co_name, c.co_firstlineno) in targets)
 
-def with_goto(func_or_code):
+    data = _CodeData(code)
+    data.get_name(_PATCHED_MARKER)
+    return _make_code(code, code.co_code, data)
+
+
+if _machinery is not None:
+    class _GotoLoader(_machinery.SourceFileLoader):
+        def source_to_code(self, data, path, _optimize=-1):
+            code = super(_GotoLoader, self).source_to_code(
+                data, path, _optimize=_optimize)
+            return _patch_module_code(code, data)
+
+        def get_code(self, fullname):
+            code = super(_GotoLoader, self).get_code(fullname)
+            if code is not None and _PATCHED_MARKER not in code.co_names:
+                # a .pyc written without the hook is still up to date;
+                # replace it, so the next import doesn't patch it again
+                source_path = self.get_filename(fullname)
+                code = _patch_module_code(code, self.get_data(source_path))
+                if not sys.dont_write_bytecode:
+                    try:
+                        _write_pyc(code, source_path)
+                    except (IOError, OSError):
+                        pass
+            return code
+
+    class _GotoFinder(object):
+        def __init__(self, packages):
+            self.packages = tuple(packages)
+
+        def find_spec(self, fullname, path=None, target=None):
+            for package in self.packages:
+                if fullname == package or fullname.startswith(package + '.'):
+                    break
+            else:
+                return None
+
+            spec = _machinery.PathFinder.find_spec(fullname, path)
+            if spec is None or \
+                    type(spec.loader) is not _machinery.SourceFileLoader:
+                return None
+            spec.loader = _GotoLoader(fullname, spec.origin)
+            return spec
+
+
+def install_import_hook(packages):
+    # Functions decorated with with_goto in the given packages (and their
+    # submodules) are patched when the module is compiled, and the .pyc in
+    # __pycache__ stores the patched bytecode. Returns the finder, which can
+    # be removed from sys.meta_path again.
+    if _machinery is None:
+        raise NotImplementedError("import hook requires Python 3.4+")
+    if isinstance(packages, str):
+        packages = [packages]
+
+    finder = _GotoFinder(packages)
+    sys.meta_path.insert(0, finder)
+    return finder
+
+
+_IMPORTS_GOTO = br'^[ \t]*(?:from[ \t]+goto[ \t]+import|import[ \t]+goto\b)'
+
+
+def _write_pyc(code, source_path):
+    # a timestamp based .pyc, as py_compile would write it
+    import marshal
+    st = os.stat(source_path)
+    data = bytearray(_importlib_util.MAGIC_NUMBER)
+    if sys.version_info >= (3, 7):
+        data.extend(struct.pack('<I', 0))  # flags, see PEP 552
+    data.extend(struct.pack('<II', int(st.st_mtime) & 0xFFFFFFFF,
+                            st.st_size & 0xFFFFFFFF))
+    data.extend(marshal.dumps(code))
+    # with the mode of the source, but writable by its owner, like
+    # importlib writes it
+    _write_file_atomic(_importlib_util.cache_from_source(source_path),
+                       bytes(data), (st.st_mode | 0o200) & 0o666)
+
+
+def _compile_file(path):
+    # returns (path, number of patched functions, seconds, error)
+    start = _perf_counter()
+    try:
+        with open(path, 'rb') as f:
+            source = f.read()
+        code = _builtin_compile(source, path, 'exec', dont_inherit=True)
+        code = _patch_module_code(code, source)
+        _write_pyc(code, path)
+    except Exception as e:
+        return path, 0, _perf_counter() - start, '%s: %s' % (type(e).__name__, e)
+
+    count = sum(1 for c in _iter_code_tree(code)
+                if _PATCHED_MARKER in c.co_names) - 1
+    return path, count, _perf_counter() - start, None
+
+
+def _find_sources(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames[:] = sorted(d for d in dirnames if d != '__pycache__')
+                for filename in sorted(filenames):
+                    if filename.endswith('.py'):
+                        yield os.path.join(dirpath, filename)
+        else:
+            yield path
+
+
+def _imports_goto(path):
+    import re
+    with open(path, 'rb') as f:
+        return re.search(_IMPORTS_GOTO, f.read(), re.M) is not None
+
+
+def _main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m goto')
+    commands = parser.add_subparsers(dest='command')
+    compile_parser = commands.add_parser(
+        'compile', help='write goto-patched .pyc files for a source tree')
+    compile_parser.add_argument('paths', nargs='+', metavar='path')
+    compile_parser.add_argument('-j', '--jobs', type=int, default=None,
+                                help='number of worker processes')
+    compile_parser.add_argument('-q', '--quiet', action='store_true',
+                                help='only report errors')
+    args = parser.parse_args(argv)
+    if args.command != 'compile':
+        parser.print_usage()
+        return 2
+    if _machinery is None:
+        raise NotImplementedError("compile requires Python 3.4+")
+
+    # refer to the importable module, so workers can unpickle the function
+    import goto
+    sources = [p for p in _find_sources(args.paths) if _imports_goto(p)]
+
+    start = _perf_counter()
+    if args.jobs == 1 or len(sources) < 2:
+        results = map(goto._compile_file, sources)
+        executor = None
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=args.jobs)
+        results = executor.map(goto._compile_file, sources)
+
+    failed = False
+    total = 0
+    try:
+        for path, count, seconds, error in results:
+            if error is not None:
+                failed = True
+                sys.stderr.write('%s: %s\n' % (path, error))
+                continue
+            total += count
+            if not args.quiet:
+                print('%s: patched %d function%s in %.1f ms' % (
+                    path, count, '' if count == 1 else 's', seconds * 1000))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if not args.quiet:
+        print('%d file%s, %d function%s patched in %.2f s' % (
+            len(sources), '' if len(sources) == 1 else 's',
+            total, '' if total == 1 else 's', _perf_counter() - start))
+    return 1 if failed else 0
+
+
+_CacheInfo = collections.namedtuple(
+    'CacheInfo', 'hits misses evictions entries bytes')
+
+
+def cache_info():
+    # Statistics of the in-memory caches of patched code: hits and misses
+    # of _patch_code, evictions from the bounded caches, the number of
+    # cached code objects and their approximate size in bytes.
+    caches = (_patched_code_cache, _content_cache)
+    patched = {}
+    for cache in caches:
+        for new_code in list(cache.values()):
+            if new_code is not None:
+                patched[id(new_code)] = new_code
+    evictions = sum(getattr(cache, 'evictions', 0)
+                    for cache in caches + (_compile_cache,))
+    return _CacheInfo(_cache_hits, _cache_misses, evictions, len(patched),
+                      sum(_code_size(c) for c in patched.values()))
+
+
+def cache_clear():
+    # Empties the in-memory caches (not the directory of set_cache_dir())
+    # and resets the statistics.
+    global _cache_hits, _cache_misses
+    for cache in (_patched_code_cache, _content_cache, _compile_cache):
+        cache.clear()
+    _cache_hits = _cache_misses = 0
+
+
+def set_cache_maxsize(maxsize):
+    # Code objects that can't be weakly referenced (in which case cached
+    # entries can't go away with them) are held in LRU caches of at most
+    # maxsize entries. None makes them unbounded.
+    for cache in (_patched_code_cache, _content_cache):
+        if isinstance(cache, (_LRUCache, _IdentityCache)):
+            cache.resize(maxsize)
+
+
+def set_cache_dir(path):
+    # Entries are keyed by the code's contents, the interpreter and the
+    # version of this module, so processes may share a directory.
+    # None disables the cache.
+    global _cache_dir
+    _cache_dir = path
+
+
+_CO_NOFREE = 0x40
+# CO_GENERATOR, CO_COROUTINE, CO_ITERABLE_COROUTINE and CO_ASYNC_GENERATOR:
+# functions with these flags are patched right away even with lazy=True,
+# as a plain stub would hide what kind of function they are (e.g. from
+# inspect.iscoroutinefunction) until their first call
+_CO_NOT_LAZY = 0x20 | 0x80 | 0x100 | 0x200
+
+
+def _lazy_stub_template(*args, **kwargs):
+    return _lazy_stub_template(*args, **kwargs)
+
+
+class _LazyPatcher(object):
+    # Called by the stub code of a lazily patched function, swaps in the
+    # patched code on first call and then calls the function again.
+    def __init__(self, code, recursive=False, options=_DEFAULT_OPTIONS,
+                 bind=None):
+        self.code = code
+        self.recursive = recursive
+        self.options = options
+        # (bind_globals, bind_exclude) of with_goto, if any
+        self.bind = bind
+        self.func = None
+        self.lock = threading.Lock()
+
+    def patch(self):
+        with self.lock:
+            if self.code is None:
+                return False
+            options = self.options
+            if self.bind is not None:
+                options = _bind_globals(options, self.code,
+                                        self.func.__globals__, *self.bind)
+            if self.recursive:
+                self.func.__code__ = _patch_code_recursive(self.code, options)
+            else:
+                self.func.__code__ = _patch_code(self.code, options)
+            self.code = None
+        return True
+
+    def __call__(self, *args, **kwargs):
+        self.patch()
+        return self.func(*args, **kwargs)
+
+
+def _get_lazy_patcher(func):
+    consts = func.__code__.co_consts
+    if consts and isinstance(consts[0], _LazyPatcher):
+        return consts[0]
+    return None
+
+
+def _make_lazy_stub(code, patcher):
+    # a code object with the same free variables as code, that forwards
+    # all arguments to patcher (by loading it as a constant instead of
+    # the global the template refers to)
+    template = _lazy_stub_template.__code__
+    buf = array.array('B', template.co_code)
+    instructions = _Instructions(template.co_code)
+    for i in range(instructions.count):
+        if dis.opname[instructions.opcodes[i]] == 'LOAD_GLOBAL':
+            _write_instruction(buf, instructions.offsets[i], 'LOAD_CONST', 0)
+
+    data = _CodeData(template)
+    data.consts = (patcher,)
+    data.names = ()
+    flags = template.co_flags
+    if code.co_freevars:
+        flags &= ~_CO_NOFREE
+    return _make_code(template, _array_to_bytes(buf), data,
+                      co_flags=flags,
+                      co_freevars=code.co_freevars,
+                      co_name=code.co_name,
+                      co_filename=code.co_filename,
+                      co_firstlineno=code.co_firstlineno)
+
+
+_CLASS_TYPES = (type, getattr(types, 'ClassType', type))
+
+
+def _iter_functions(namespace, module_name, seen=None):
+    # functions, methods, static/class methods and property accessors
+    # defined in the namespace of a module or class, and its nested classes
+    # (but not those imported from other modules)
+    if seen is None:
+        seen = set()
+    for value in list(namespace.values()):
+        if isinstance(value, (staticmethod, classmethod)):
+            value = value.__func__
+        if isinstance(value, property):
+            for accessor in (value.fget, value.fset, value.fdel):
+                if isinstance(accessor, types.FunctionType) and \
+                        accessor.__module__ == module_name:
+                    yield accessor
+        elif isinstance(value, types.FunctionType):
+            if value.__module__ == module_name:
+                yield value
+        elif isinstance(value, _CLASS_TYPES) and \
+                getattr(value, '__module__', None) == module_name and \
+                id(value) not in seen:
+            seen.add(id(value))
+            for func in _iter_functions(vars(value), module_name, seen):
+                yield func
+
+
+def _code_size(code):
+    # approximate, shared objects such as interned names are counted too
+    return sum(sys.getsizeof(obj) for obj in (
+        code, code.co_code, code.co_consts, code.co_names, code.co_varnames))
+
+
+def _iter_modules(modules_or_packages):
+    import pkgutil
+    if isinstance(modules_or_packages, (str, types.ModuleType)):
+        modules_or_packages = [modules_or_packages]
+    for module in modules_or_packages:
+        if isinstance(module, str):
+            module = importlib.import_module(module)
+        yield module
+        path = getattr(module, '__path__', None)
+        if path is not None:
+            for _, name, _ in pkgutil.walk_packages(path,
+                                                    module.__name__ + '.'):
+                yield importlib.import_module(name)
+
+
+_PrepatchInfo = collections.namedtuple('PrepatchInfo',
+                                       'modules functions bytes')
+
+
+def prepatch(modules_or_packages, freeze=False):
+    # Patches the lazily decorated functions of the given modules (and the
+    # submodules of packages), e.g. before forking worker processes, so the
+    # workers share the patched code. With freeze=True, gc.freeze() (3.7+)
+    # is called afterwards, so the garbage collector doesn't touch the
+    # pages of the parent's objects either.
+    modules = functions = size = 0
+    seen = set()
+    for module in _iter_modules(modules_or_packages):
+        if id(module) in seen:
+            continue
+        seen.add(id(module))
+        modules += 1
+        for func in _iter_functions(vars(module), module.__name__):
+            patcher = _get_lazy_patcher(func)
+            if patcher is not None and patcher.patch():
+                functions += 1
+                size += _code_size(func.__code__)
+
+    if freeze:
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+
+    return _PrepatchInfo(modules, functions, size)
+
+
+def _patch_functions_in_place(funcs, lazy):
+    # Replacing __code__ keeps the function objects (and anything referring
+    # to them), so there is no wrapper to create and update.
+    count = 0
+    for func in funcs:
+        code = func.__code__
+        # functions not referring to goto/label are skipped without
+        # decoding their bytecode
+        if _GOTO_NAMES.isdisjoint(code.co_names) or \
+                _PATCHED_MARKER in code.co_names:
+            continue
+        if lazy and not code.co_flags & _CO_NOT_LAZY:
+            patcher = _LazyPatcher(code)
+            patcher.func = func
+            func.__code__ = _make_lazy_stub(code, patcher)
+        else:
+            func.__code__ = _patch_code(code)
+        count += 1
+    return count
+
+
+def patch_module(module, lazy=False):
+    # Patches all functions, methods, static/class methods and properties
+    # defined in module in place, as if each was decorated with with_goto.
+    # Returns the number of patched functions.
+    return _patch_functions_in_place(
+        _iter_functions(vars(module), module.__name__), lazy)
+
+
+def patch_class(cls=None, lazy=False):
+    # Class decorator, see patch_module().
+    if cls is None:
+        return functools.partial(patch_class, lazy=lazy)
+    _patch_functions_in_place(_iter_functions(vars(cls), cls.__module__),
+                              lazy)
+    return cls
+
+
+_keep_original = True
+_released_bytes = 0
+_dead_code_bytes = 0
+_release_watchers = {}
+
+
+def _watch_release(code):
+    # adds the size of code to the released bytes once it is collected
+    size = _code_size(code)
+
+    def released(ref):
+        global _released_bytes
+        if _release_watchers.pop(id(ref), None) is not None:
+            _released_bytes += size
+
+    try:
+        ref = weakref.ref(code, released)
+    except TypeError:
+        return
+    _release_watchers[id(ref)] = ref
+
+
+_MemoryInfo = collections.namedtuple('MemoryInfo',
+                                     'released_bytes dead_code_bytes')
+
+
+def memory_info():
+    # released_bytes: approximate size of the original code objects of
+    # functions decorated with keep_original=False that have been freed
+    # dead_code_bytes: size of the unreachable code dropped from code
+    # patched with remove_dead_code=True
+    return _MemoryInfo(_released_bytes, _dead_code_bytes)
+
+
+def set_keep_original(keep_original):
+    # Default for with_goto(keep_original=...).
+    global _keep_original
+    _keep_original = keep_original
+
+
+def with_goto(func_or_code=None, lazy=False, recursive=False,
+              keep_original=None, compact=False, thread_jumps=False,
+              remove_dead_code=False, constants=None, bind_globals=False,
+              bind_exclude=()):
+    # With lazy=True, functions are patched on their first call, rather
+    # than when decorated. Code objects are always patched right away.
+    # With recursive=True, nested code objects that refer to goto or label
+    # are patched as well.
+    # With keep_original=False, the decorated function doesn't refer to the
+    # original one through __wrapped__, so the unpatched code can be freed.
+    # With compact=True, the code is reassembled without the NOPs and extra
+    # jumps that are left when patching it in place.
+    # With thread_jumps=True, gotos and jumps to a label followed by another
+    # goto go to that goto's label directly.
+    # With remove_dead_code=True, the code is reassembled like with
+    # compact=True, leaving out code that can't be reached, e.g. after a goto.
+    # constants maps global names to values they are assumed to have: loads
+    # of these names become constants, and branches on them are decided when
+    # patching (with remove_dead_code=True, the arms not taken are dropped).
+    # With bind_globals=True (or a list of names), the globals and builtins
+    # loaded by a function (or only those listed), except those in
+    # bind_exclude, are added to constants with their values when patching.
+    if func_or_code is None:
+        return functools.partial(with_goto, lazy=lazy, recursive=recursive,
+                                 keep_original=keep_original, compact=compact,
+                                 thread_jumps=thread_jumps,
+                                 remove_dead_code=remove_dead_code,
+                                 constants=constants,
+                                 bind_globals=bind_globals,
+                                 bind_exclude=bind_exclude)
+
+    options = _Options(compact=compact, thread_jumps=thread_jumps,
+                       remove_dead_code=remove_dead_code,
+                       constants=tuple(sorted((constants or {}).items())))
+    patch = _patch_code_recursive if recursive else _patch_code
+    bind = (bind_globals, bind_exclude) if bind_globals else None
     if isinstance(func_or_code, types.CodeType):
-        return _patch_code(func_or_code)
-
-    return functools.update_wrapper(
-        types.FunctionType(
-            _patch_code(func_or_code.__code__),
-            func_or_code.__globals__,
-            func_or_code.__name__,
-            func_or_code.__defaults__,
-            func_or_code.__closure__,
-        ),
-        func_or_code
+        if bind is not None:
+            raise TypeError('bind_globals needs a function, not a code object')
+        return patch(func_or_code, options)
+
+    code = func_or_code.__code__
+    patcher = None
+    if lazy and _PATCHED_MARKER not in code.co_names and \
+            not code.co_flags & _CO_NOT_LAZY:
+        patcher = _LazyPatcher(code, recursive, options, bind)
+        code = _make_lazy_stub(code, patcher)
+    else:
+        if bind is not None:
+            options = _bind_globals(options, code, func_or_code.__globals__,
+                                    *bind)
+        code = patch(code, options)
+
+    func = types.FunctionType(
+        code,
+        func_or_code.__globals__,
+        func_or_code.__name__,
+        func_or_code.__defaults__,
+        func_or_code.__closure__,
     )
+    if patcher is not None:
+        patcher.func = func
+    functools.update_wrapper(func, func_or_code)
+
+    if keep_original is None:
+        keep_original = _keep_original
+    if not keep_original:
+        func.__dict__.pop('__wrapped__', None)
+        if func.__code__ is not func_or_code.__code__:
+            _watch_release(func_or_code.__code__)
+    return func
+
+
+def _reduce_code(code):
+    # patched code is pickled in marshal format, guarded by the bytecode
+    # magic number and the goto version, as it is only valid for those
+    import marshal
+    if _PATCHED_MARKER not in code.co_names:
+        raise TypeError("cannot pickle code objects that aren't patched")
+    return _load_code, (_MAGIC_NUMBER, __version__, marshal.dumps(code))
+
+
+def _load_code(magic, version, data):
+    if magic != _MAGIC_NUMBER or version != __version__:
+        raise ValueError("goto code was pickled for a different interpreter "
+                         "or goto version")
+    import marshal
+    return marshal.loads(data)
+
+
+copyreg.pickle(types.CodeType, _reduce_code)
+
+
+def _make_cell(value):
+    return (lambda: value).__closure__[0]
+
+
+def _make_empty_cell():
+    if False:
+        value = None
+    return (lambda: value).__closure__[0]
+
+
+class _ModuleRef(object):
+    def __init__(self, name):
+        self.name = name
+
+
+def _make_function(code, referenced_globals, name, defaults, closure,
+                   attrs):
+    func_globals = {'__builtins__': builtins}
+    for key, value in referenced_globals.items():
+        if isinstance(value, _ModuleRef):
+            value = importlib.import_module(value.name)
+        func_globals[key] = value
+    if closure is not None:
+        closure = tuple(_make_empty_cell() if value is _make_empty_cell
+                        else _make_cell(value) for value in closure)
+    func = types.FunctionType(code, func_globals, name, defaults, closure)
+    for key, value in attrs.items():
+        setattr(func, key, value)
+    return func
+
+
+class _PicklableFunction(object):
+    __slots__ = ['func']
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+    def __reduce__(self):
+        func = self.func
+        names = set()
+        for code in _iter_code_tree(func.__code__):
+            names.update(code.co_names)
+        referenced_globals = {}
+        for key in names - _GOTO_NAMES:
+            if key in func.__globals__:
+                value = func.__globals__[key]
+                if isinstance(value, types.ModuleType):
+                    value = _ModuleRef(value.__name__)
+                referenced_globals[key] = value
+
+        closure = None
+        if func.__closure__ is not None:
+            closure = []
+            for cell in func.__closure__:
+                try:
+                    closure.append(cell.cell_contents)
+                except ValueError:
+                    closure.append(_make_empty_cell)  # unbound
+        attrs = dict(func.__dict__)
+        attrs.pop('__wrapped__', None)  # the unpatched function
+        for key in ('__kwdefaults__', '__qualname__', '__doc__', '__module__'):
+            if getattr(func, key, None) is not None:
+                attrs[key] = getattr(func, key)
+        return _make_function, (func.__code__, referenced_globals,
+                                func.__name__, func.__defaults__, closure,
+                                attrs)
+
+
+def picklable(func):
+    # Wraps a patched function, e.g. one created from generated code, so it
+    # can be sent to other processes (like ProcessPoolExecutor workers) by
+    # value, along with the globals it refers to and its closure. Modules
+    # are re-imported by name. It is unpickled as a plain function with the
+    # already patched code, which must have been patched by the same
+    # interpreter and goto version.
+    return _PicklableFunction(func)
+
+
+_compile_cache = _LRUCache(256)
+
+# the co_flags of a caller that compile() inherits
+_FUTURE_FLAGS = 0
+for _feature in __future__.all_feature_names:
+    _FUTURE_FLAGS |= getattr(__future__, _feature).compiler_flag
+del _feature
+
+
+def _compile_key(source, filename, mode, flags, dont_inherit, optimize):
+    import hashlib
+    h = hashlib.sha1()
+    if isinstance(source, bytes):
+        _update_hash(h, 'bytes')
+        _update_hash(h, source)
+    else:
+        _update_hash(h, 'text')
+        _update_hash(h, source.encode('utf-8', 'surrogatepass'))
+    _update_hash(h, (filename, mode, flags, dont_inherit, optimize))
+    return h.digest()
+
+
+def compile(source, filename, mode, flags=0, dont_inherit=False, optimize=-1):
+    # Like the builtin compile(), but returns code patched with
+    # with_goto(..., recursive=True). The results for the most recently
+    # compiled sources are memoized.
+    import ast
+    if not dont_inherit:
+        # the builtin would inherit the future statements of this module,
+        # rather than those of the caller
+        flags |= sys._getframe(1).f_code.co_flags & _FUTURE_FLAGS
+        dont_inherit = True
+    args = (source, filename, mode, flags, dont_inherit)
+    if optimize != -1:
+        args += (optimize,)  # PY3
+
+    if not isinstance(source, (bytes, type(u''))) or flags & ast.PyCF_ONLY_AST:
+        code = _builtin_compile(*args)
+        if isinstance(code, types.CodeType):
+            code = _patch_code_recursive(code)
+        return code
+
+    key = _compile_key(source, filename, mode, flags, dont_inherit, optimize)
+    code = _compile_cache.get(key)
+    if code is None:
+        code = _patch_code_recursive(_builtin_compile(*args))
+        _compile_cache[key] = code
+    return code
 
 
 class _CatchAll:
@@ -563,3 +2608,7 @@ class _CatchAll:
 # Not strictly necessary, but stops linters from freaking out.
 label = _CatchAll()
 goto = _CatchAll()
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -1,5 +1,9 @@
 import sys
+import os
+import array
+import types
 import pytest
+import goto as goto_module
 from goto import with_goto, label, goto
 
 NonConstFalse = False
@@ -1076,3 +1080,1421 @@ def test_code_is_not_copy():
     assert outer_func() is not outer_func()
     assert outer_func().__code__ is outer_func().__code__
 
+
+def test_import_is_light():
+    import subprocess
+    script = ('import sys; before = set(sys.modules); import goto; '
+              'print(" ".join(sorted(set(sys.modules) - before)))')
+    out = subprocess.check_output([sys.executable, '-c', script],
+                                  cwd=os.path.dirname(goto_module.__file__))
+    imported = set(out.decode().split())
+    for name in ('ast', 'tempfile', 'hashlib', 'pkgutil', 'numpy'):
+        assert name not in imported
+
+
+@pytest.fixture
+def no_repatch(monkeypatch):
+    # call it to make any further patching fail the test
+    def install(name='_find_labels_and_gotos'):
+        def fail(*args):
+            raise AssertionError('code was patched again')
+
+        monkeypatch.setattr(goto_module, name, fail)
+    return install
+
+
+def test_disk_cache(tmpdir, no_repatch):
+    func = make_function(CODE.splitlines())
+    goto_module.set_cache_dir(str(tmpdir))
+    try:
+        assert with_goto(func)() == EXPECTED
+        assert len(tmpdir.listdir()) == 1
+
+        no_repatch()
+        goto_module._patched_code_cache.clear()
+        goto_module._content_cache.clear()
+        assert with_goto(func)() == EXPECTED
+    finally:
+        goto_module.set_cache_dir(None)
+
+
+def test_disk_cache_ignores_bad_entries(tmpdir):
+    func = make_function(CODE.splitlines())
+    goto_module.set_cache_dir(str(tmpdir))
+    try:
+        goto_module._patched_code_cache.clear()
+        goto_module._content_cache.clear()
+        with_goto(func)
+        entry, = tmpdir.listdir()
+        entry.write_binary(b'\0garbage')
+        goto_module._patched_code_cache.clear()
+        goto_module._content_cache.clear()
+        assert with_goto(func)() == EXPECTED
+    finally:
+        goto_module.set_cache_dir(None)
+
+
+HOOKED_MODULE = '''\
+from goto import with_goto
+
+@with_goto
+def func():
+    i = 0
+    label .start
+    if i == 10:
+        goto .end
+    i += 1
+    goto .start
+    label .end
+    return i
+
+def outer():
+    @with_goto
+    def inner():
+        result = 'inner'
+        goto .end
+        result = 'skipped'
+        label .end
+        return result
+    return inner
+
+def unpatched():
+    goto .end
+    label .end
+'''
+
+
+@pytest.mark.skipif(sys.version_info < (3, 4), reason="requires importlib")
+def test_import_hook(tmpdir, monkeypatch, no_repatch):
+    pkg = tmpdir.mkdir('goto_hooked')
+    pkg.join('__init__.py').write('')
+    pkg.join('mod.py').write(HOOKED_MODULE)
+    monkeypatch.syspath_prepend(str(tmpdir))
+    monkeypatch.setattr(sys, 'dont_write_bytecode', False)
+
+    hook = goto_module.install_import_hook(['goto_hooked'])
+    try:
+        from goto_hooked import mod
+        assert mod.func() == 10
+        assert mod.outer()() == 'inner'
+        pytest.raises(NameError, mod.unpatched)
+        assert pkg.join('__pycache__').listdir('mod.*.pyc')
+
+        no_repatch()
+        del sys.modules['goto_hooked.mod']
+        from goto_hooked import mod
+        assert mod.func() == 10
+        assert mod.outer()() == 'inner'
+    finally:
+        sys.meta_path.remove(hook)
+        sys.modules.pop('goto_hooked.mod', None)
+        sys.modules.pop('goto_hooked', None)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 4), reason="requires importlib")
+def test_import_hook_replaces_stale_pyc(tmpdir, monkeypatch, no_repatch):
+    # a .pyc written by an import without the hook is patched only once
+    pkg = tmpdir.mkdir('goto_hooked_stale')
+    pkg.join('__init__.py').write('')
+    pkg.join('mod.py').write(HOOKED_MODULE)
+    monkeypatch.syspath_prepend(str(tmpdir))
+    monkeypatch.setattr(sys, 'dont_write_bytecode', False)
+
+    def unimport():
+        sys.modules.pop('goto_hooked_stale.mod', None)
+        sys.modules.pop('goto_hooked_stale', None)
+
+    from goto_hooked_stale import mod
+    unimport()
+    assert pkg.join('__pycache__').listdir('mod.*.pyc')
+
+    hook = goto_module.install_import_hook(['goto_hooked_stale'])
+    try:
+        from goto_hooked_stale import mod
+        assert mod.func() == 10
+        unimport()
+
+        no_repatch('_patch_module_code')
+        from goto_hooked_stale import mod
+        assert mod.func() == 10
+    finally:
+        sys.meta_path.remove(hook)
+        unimport()
+
+
+HOOKED_OPTIONS_MODULE = '''\
+from goto import with_goto
+
+@with_goto(constants={'DEBUG': True})
+def flagged():
+    result = 'debug'
+    if not DEBUG:
+        result = 'no debug'
+    return result
+
+@with_goto(compact=True)
+def compact():
+    goto .end
+    label .end
+'''
+
+
+@pytest.mark.skipif(sys.version_info < (3, 4), reason="requires importlib")
+def test_import_hook_keeps_decorator_options(tmpdir, monkeypatch):
+    # functions decorated with options are left to with_goto at run time
+    pkg = tmpdir.mkdir('goto_hooked_options')
+    pkg.join('__init__.py').write('')
+    pkg.join('mod.py').write(HOOKED_OPTIONS_MODULE)
+    monkeypatch.syspath_prepend(str(tmpdir))
+
+    hook = goto_module.install_import_hook(['goto_hooked_options'])
+    try:
+        from goto_hooked_options import mod
+        assert mod.flagged() == 'debug'
+        if sys.version_info < (3, 11):
+            nop = goto_module.dis.opmap['NOP']
+            assert nop not in goto_module._Instructions(
+                mod.compact.__code__.co_code).opcodes
+    finally:
+        sys.meta_path.remove(hook)
+        sys.modules.pop('goto_hooked_options.mod', None)
+        sys.modules.pop('goto_hooked_options', None)
+
+
+def test_options_for_patched_code():
+    patched = with_goto(make_function(CODE.splitlines()))
+    pytest.raises(ValueError, with_goto, patched, compact=True)
+    assert with_goto(patched).__code__ is patched.__code__
+
+
+@pytest.mark.skipif(sys.version_info < (3, 4), reason="requires importlib")
+def test_compile_command(tmpdir, monkeypatch, capsys, no_repatch):
+    pkg = tmpdir.mkdir('goto_compiled')
+    pkg.join('__init__.py').write('')
+    pkg.join('mod.py').write(HOOKED_MODULE)
+    pkg.join('other.py').write('x = 1\n')
+
+    assert goto_module._main(['compile', '-j', '1', str(tmpdir)]) == 0
+    out = capsys.readouterr()[0]
+    assert 'mod.py: patched 2 functions' in out
+    assert '1 file, 2 functions patched' in out
+    assert pkg.join('__pycache__').listdir('mod.*.pyc')
+    assert not pkg.join('__pycache__').listdir('other.*.pyc')
+
+    # the .pyc is picked up by the regular import machinery
+    monkeypatch.syspath_prepend(str(tmpdir))
+    no_repatch()
+    try:
+        from goto_compiled import mod
+        assert mod.func() == 10
+        assert mod.outer()() == 'inner'
+    finally:
+        sys.modules.pop('goto_compiled.mod', None)
+        sys.modules.pop('goto_compiled', None)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 4), reason="requires importlib")
+@pytest.mark.skipif(os.name != 'posix', reason="POSIX file modes")
+def test_pyc_mode_follows_source(tmpdir, monkeypatch):
+    pkg = tmpdir.mkdir('goto_pyc_mode')
+    pkg.join('__init__.py').write('')
+    pkg.join('mod.py').write(HOOKED_MODULE)
+    pkg.join('mod.py').chmod(0o444)
+
+    def pyc_mode():
+        return pkg.join('__pycache__').listdir('mod.*.pyc')[0].stat().mode
+
+    assert goto_module._main(['compile', '-j', '1', str(tmpdir)]) == 0
+    assert pyc_mode() & 0o777 == 0o644
+
+    # a stale .pyc rewritten by the import hook
+    pkg.join('__pycache__').remove()
+    pkg.join('mod.py').chmod(0o640)
+    monkeypatch.syspath_prepend(str(tmpdir))
+    monkeypatch.setattr(sys, 'dont_write_bytecode', False)
+    try:
+        from goto_pyc_mode import mod
+        del sys.modules['goto_pyc_mode.mod']
+        del sys.modules['goto_pyc_mode']
+        hook = goto_module.install_import_hook(['goto_pyc_mode'])
+        try:
+            from goto_pyc_mode import mod
+            assert mod.func() == 10
+        finally:
+            sys.meta_path.remove(hook)
+    finally:
+        sys.modules.pop('goto_pyc_mode.mod', None)
+        sys.modules.pop('goto_pyc_mode', None)
+    pyc = pkg.join('__pycache__').listdir('mod.*.pyc')[0]
+    assert goto_module._PATCHED_MARKER.encode() in pyc.read_binary()
+    assert pyc_mode() & 0o777 == 0o640
+
+
+def test_lazy():
+    def func(start, step=1):
+        i = start
+        label .start
+        if i >= 10:
+            goto .end
+        i += step
+        goto .start
+        label .end
+        return i
+
+    lazy_func = with_goto(lazy=True)(func)
+    assert lazy_func.__code__ is not func.__code__
+    assert lazy_func.__code__.co_name == 'func'
+    stub_code = lazy_func.__code__
+
+    assert lazy_func(0, step=3) == 12
+    assert lazy_func.__code__ is not stub_code
+    assert lazy_func.__code__ is with_goto(func).__code__
+    assert lazy_func(5) == 10
+
+
+def test_lazy_closure():
+    def outer():
+        x = []
+
+        @with_goto(lazy=True)
+        def inner():
+            goto .end
+            x.append('skipped')
+            label .end
+            x.append('inner')
+            return x
+        return inner
+
+    assert outer()() == ['inner']
+
+
+def test_lazy_unknown_label():
+    @with_goto(lazy=True)
+    def func():
+        goto .unknown
+
+    pytest.raises(SyntaxError, func)
+
+
+def test_lazy_generator_and_coroutine():
+    import inspect
+
+    def gen():
+        goto .end
+        yield 'skipped'
+        label .end
+        yield 'end'
+
+    lazy_gen = with_goto(gen, lazy=True)
+    assert inspect.isgeneratorfunction(lazy_gen)
+    assert list(lazy_gen()) == ['end']
+
+    if sys.version_info >= (3, 5):
+        ns = {}
+        exec('async def coro():\n'
+             '    result = "end"\n'
+             '    goto .end\n'
+             '    result = "skipped"\n'
+             '    label .end\n'
+             '    return result\n', ns)
+        lazy_coro = with_goto(ns['coro'], lazy=True)
+        assert inspect.iscoroutinefunction(lazy_coro)
+        coro = lazy_coro()
+        with pytest.raises(StopIteration) as excinfo:
+            coro.send(None)
+        assert excinfo.value.value == 'end'
+
+
+def test_lazy_threads():
+    import threading
+
+    @with_goto(lazy=True)
+    def func(i):
+        goto .end
+        i = None
+        label .end
+        return i
+
+    barrier = threading.Event()
+    results = []
+
+    def call(i):
+        barrier.wait()
+        results.append(func(i))
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    barrier.set()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results) == list(range(8))
+
+
+LAZY_MODULE = '''\
+from goto import with_goto
+
+@with_goto(lazy=True)
+def func():
+    goto .end
+    label .end
+    return 'func'
+
+class Class(object):
+    @with_goto(lazy=True)
+    def method(self):
+        goto .end
+        label .end
+        return 'method'
+
+    @staticmethod
+    @with_goto(lazy=True)
+    def static():
+        goto .end
+        label .end
+        return 'static'
+
+    @property
+    @with_goto(lazy=True)
+    def prop(self):
+        goto .end
+        label .end
+        return 'prop'
+'''
+
+
+def test_prepatch(tmpdir, monkeypatch, no_repatch):
+    pkg = tmpdir.mkdir('goto_prepatched')
+    pkg.join('__init__.py').write('')
+    pkg.join('mod.py').write(LAZY_MODULE)
+    monkeypatch.syspath_prepend(str(tmpdir))
+    try:
+        info = goto_module.prepatch(['goto_prepatched'])
+        from goto_prepatched import mod
+        assert info.modules == 2
+        assert info.functions == 4
+        assert info.bytes > 0
+
+        no_repatch()
+        assert goto_module.prepatch(mod).functions == 0
+        assert mod.Class().method() == 'method'
+        assert mod.Class.static() == 'static'
+        assert mod.Class().prop == 'prop'
+    finally:
+        sys.modules.pop('goto_prepatched.mod', None)
+        sys.modules.pop('goto_prepatched', None)
+
+
+UNDECORATED_MODULE = '''\
+def func():
+    goto .end
+    label .end
+    return 'func'
+
+def no_goto():
+    return 'no_goto'
+
+class Class(object):
+    def method(self):
+        goto .end
+        label .end
+        return 'method'
+
+    @staticmethod
+    def static():
+        goto .end
+        label .end
+        return 'static'
+
+    @classmethod
+    def clsmethod(cls):
+        goto .end
+        label .end
+        return 'clsmethod'
+
+    @property
+    def prop(self):
+        goto .end
+        label .end
+        return 'prop'
+
+    class Nested(object):
+        def method(self):
+            goto .end
+            label .end
+            return 'nested'
+'''
+
+
+def make_module(source):
+    import types
+    module = types.ModuleType('goto_generated')
+    exec(source, vars(module))
+    return module
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_patch_module(lazy):
+    mod = make_module(UNDECORATED_MODULE)
+    func = mod.func
+    assert goto_module.patch_module(mod, lazy=lazy) == 6
+    assert mod.func is func
+    assert mod.func() == 'func'
+    assert mod.no_goto() == 'no_goto'
+    assert mod.Class().method() == 'method'
+    assert mod.Class.static() == 'static'
+    assert mod.Class.clsmethod() == 'clsmethod'
+    assert mod.Class().prop == 'prop'
+    assert mod.Class.Nested().method() == 'nested'
+    assert goto_module.patch_module(mod, lazy=lazy) == 0
+
+
+def test_patch_module_skips_imported_functions():
+    other = make_module(UNDECORATED_MODULE)
+    mod = types.ModuleType('goto_importer')
+    mod.func = other.func
+    code = other.func.__code__
+    assert goto_module.patch_module(mod) == 0
+    assert other.func.__code__ is code
+
+
+def test_patch_module_skips_functions_without_goto(no_repatch):
+    mod = make_module('def func():\n    return 1\n')
+    no_repatch()
+    assert goto_module.patch_module(mod) == 0
+
+
+def test_patch_class():
+    @goto_module.patch_class
+    class Class(object):
+        def method(self):
+            goto .end
+            label .end
+            return 'method'
+
+    @goto_module.patch_class(lazy=True)
+    class LazyClass(object):
+        def method(self):
+            goto .end
+            label .end
+            return 'method'
+
+    assert Class().method() == 'method'
+    assert LazyClass().method() == 'method'
+
+
+NESTED_CODE = '''\
+def count(n):
+    i = 0
+    label .start
+    if i == n:
+        goto .end
+    i += 1
+    goto .start
+    label .end
+    return i
+
+class Class:
+    def method(self):
+        result = 'method'
+        goto .end
+        result = 'skipped'
+        label .end
+        return result
+
+    def plain(self):
+        return 'plain'
+
+    result = []
+    i = 0
+    label .start
+    result.append(i)
+    i += 1
+    if i < 3:
+        goto .start
+
+outer = lambda: count
+'''
+
+
+def test_recursive_code():
+    code = compile(NESTED_CODE, '', 'exec')
+    ns = {}
+    exec(with_goto(code, recursive=True), ns)
+    assert ns['count'](5) == 5
+    assert ns['outer']()(3) == 3
+    assert ns['Class'].result == [0, 1, 2]
+    assert ns['Class']().method() == 'method'
+    assert ns['Class']().plain() == 'plain'
+
+
+def test_recursive_function():
+    def outer(x):
+        def inner():
+            goto .end
+            x.append('skipped')
+            label .end
+            x.append('inner')
+        inner()
+        goto .end
+        x.append('skipped')
+        label .end
+        return x
+
+    assert with_goto(outer, recursive=True)([]) == ['inner']
+    assert with_goto(outer, lazy=True, recursive=True)([]) == ['inner']
+
+
+def test_compile():
+    code = goto_module.compile(CODE, '<goto>', 'exec')
+    assert goto_module.compile(CODE, '<goto>', 'exec') is code
+    assert goto_module.compile(CODE, '<other>', 'exec') is not code
+
+    ns = {}
+    exec(code, ns)
+    assert ns['result'] == EXPECTED
+
+    ns = {}
+    exec(goto_module.compile(NESTED_CODE.encode('utf-8'), '', 'exec'), ns)
+    assert ns['count'](5) == 5
+
+    assert eval(goto_module.compile('1 + 1', '', 'eval')) == 2
+
+
+def test_compile_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(goto_module._compile_cache, 'maxsize', 2)
+    first = goto_module.compile('x = 1', '', 'exec')
+    goto_module.compile('x = 2', '', 'exec')
+    assert goto_module.compile('x = 1', '', 'exec') is first
+    goto_module.compile('x = 3', '', 'exec')
+    assert goto_module.compile('x = 1', '', 'exec') is first
+    assert len(goto_module._compile_cache) == 2
+
+
+def test_compile_ast():
+    import ast
+    tree = goto_module.compile(CODE, '', 'exec', ast.PyCF_ONLY_AST)
+    assert isinstance(tree, ast.Module)
+
+    ns = {}
+    exec(goto_module.compile(tree, '', 'exec'), ns)
+    assert ns['result'] == EXPECTED
+
+
+FUTURE_CALLER = '''\
+from __future__ import division
+import goto
+code = goto.compile('result = 1 / 2', '', 'exec')
+'''
+
+
+def test_compile_inherits_callers_future_flags():
+    # the same source, compiled from a caller without the future statement
+    ns = {}
+    exec(goto_module.compile('result = 1 / 2', '', 'exec'), ns)
+    assert ns['result'] == (0.5 if sys.version_info >= (3,) else 0)
+
+    caller_ns = {}
+    exec(compile(FUTURE_CALLER, '', 'exec'), caller_ns)
+    ns = {}
+    exec(caller_ns['code'], ns)
+    assert ns['result'] == 0.5
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="No postponed annotations")
+def test_compile_inherits_postponed_annotations():
+    caller_ns = {}
+    exec(compile(
+        'from __future__ import annotations\n'
+        'import goto\n'
+        'code = goto.compile("def func(x: Undefined): pass", "", "exec")\n',
+        '', 'exec'), caller_ns)
+    ns = {}
+    exec(caller_ns['code'], ns)
+    assert ns['func'].__annotations__ == {'x': 'Undefined'}
+
+
+def test_star_import_keeps_builtin_compile():
+    ns = {}
+    exec('from goto import *', ns)
+    assert 'compile' not in ns
+    assert ns['with_goto'] is with_goto
+    for name in goto_module.__all__:
+        assert name in ns
+
+
+def test_equal_code_is_patched_once(no_repatch):
+    patched = with_goto(make_function(CODE.splitlines()))
+
+    # e.g. a reloaded module, which the identity cache doesn't know
+    no_repatch()
+    goto_module._patched_code_cache.clear()
+    func = make_function(CODE.splitlines())
+    assert with_goto(func).__code__ is patched.__code__
+    assert with_goto(func)() == EXPECTED
+
+
+def test_equal_code_from_different_files():
+    code = compile(CODE, 'first.py', 'exec')
+    other_code = compile(CODE, 'second.py', 'exec')
+    patched = with_goto(code)
+    assert patched.co_filename == 'first.py'
+    assert with_goto(other_code).co_filename == 'second.py'
+
+
+def test_identity_cache_drops_collected_code():
+    import gc
+
+    cache = goto_module._IdentityCache()
+    code = compile(CODE, '', 'exec')
+    cache[code] = 'patched'
+    assert cache.get(code) == 'patched'
+    assert cache.get(compile(CODE, '', 'exec')) is None
+    del code
+    gc.collect()
+    assert len(cache) == 0
+
+
+def test_cache_info():
+    goto_module.cache_clear()
+    assert goto_module.cache_info() == (0, 0, 0, 0, 0)
+
+    func = make_function(CODE.splitlines())
+    with_goto(func)
+    with_goto(func)
+    info = goto_module.cache_info()
+    assert (info.hits, info.misses, info.entries) == (1, 1, 1)
+    assert info.bytes > 0
+
+    goto_module.cache_clear()
+    assert goto_module.cache_info() == (0, 0, 0, 0, 0)
+
+
+def test_lru_cache_fallback(monkeypatch):
+    monkeypatch.setattr(goto_module, '_patched_code_cache',
+                        goto_module._IdentityCache(goto_module._LRUCache(2)))
+    monkeypatch.setattr(goto_module, '_content_cache',
+                        goto_module._LRUCache(2))
+    goto_module.cache_clear()
+
+    codes = [compile(CODE + 'x = %d\n' % i, '', 'exec') for i in range(3)]
+    patched = [with_goto(code) for code in codes]
+    assert with_goto(codes[2]) is patched[2]
+    info = goto_module.cache_info()
+    assert (info.hits, info.misses, info.entries) == (1, 3, 2)
+    assert info.evictions == 2
+
+    goto_module.set_cache_maxsize(1)
+    assert goto_module.cache_info().entries == 1
+    assert with_goto(codes[2]) is patched[2]
+    goto_module.cache_clear()
+
+
+def test_concurrent_patching_is_single_flight(monkeypatch):
+    import threading
+    import time
+
+    calls = []
+    find_labels_and_gotos = goto_module._find_labels_and_gotos
+
+    def slow_find_labels_and_gotos(code, *args):
+        calls.append(code)
+        time.sleep(0.05)
+        return find_labels_and_gotos(code, *args)
+
+    monkeypatch.setattr(goto_module, '_find_labels_and_gotos',
+                        slow_find_labels_and_gotos)
+    code = compile(CODE + 'single_flight = True\n', '', 'exec')
+    unknown = compile('goto .unknown\n', '', 'exec')
+
+    barrier = threading.Event()
+    results = []
+    errors = []
+
+    def patch():
+        barrier.wait()
+        results.append(with_goto(code))
+        try:
+            with_goto(unknown)
+        except SyntaxError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=patch) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    barrier.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == len(errors) == 8
+    assert all(result is results[0] for result in results)
+    assert calls.count(code) == 1
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_keep_original(lazy):
+    import gc
+
+    func = make_function(CODE.splitlines())
+    func.__doc__ = 'doc'
+    func.foo = 'bar'
+    released = goto_module.memory_info().released_bytes
+
+    newfunc = with_goto(func, lazy=lazy, keep_original=False)
+    newfunc.__globals__['func'] = newfunc  # as decorating it would
+    assert not hasattr(newfunc, '__wrapped__')
+    assert (newfunc.__name__, newfunc.__doc__, newfunc.foo) == \
+        ('func', 'doc', 'bar')
+
+    del func
+    gc.collect()
+    assert newfunc() == EXPECTED
+    gc.collect()
+    assert goto_module.memory_info().released_bytes > released
+
+
+def test_keep_original_default():
+    func = make_function(CODE.splitlines())
+    goto_module.set_keep_original(False)
+    try:
+        assert not hasattr(with_goto(func), '__wrapped__')
+        if sys.version_info >= (3, 2):
+            assert with_goto(keep_original=True)(func).__wrapped__ is func
+    finally:
+        goto_module.set_keep_original(True)
+
+
+def test_pickle_code(no_repatch):
+    import pickle
+    code = with_goto(compile(CODE + 'pickled = True\n', '', 'exec'))
+    data = pickle.dumps(code)
+
+    no_repatch()
+    ns = {}
+    exec(pickle.loads(data), ns)
+    assert ns['result'] == EXPECTED
+
+    pytest.raises((TypeError, pickle.PicklingError),
+                  pickle.dumps, compile(CODE, '', 'exec'))
+
+
+def test_pickle_code_version_guard():
+    code = with_goto(compile(CODE, '', 'exec'))
+    load, (magic, version, data) = goto_module._reduce_code(code)
+    assert load(magic, version, data) == code
+    pytest.raises(ValueError, load, b'\0\0\0\0', version, data)
+    pytest.raises(ValueError, load, magic, '0.0', data)
+
+
+def test_pickle_function():
+    import pickle
+    ns = {}
+    exec('\n'.join([
+        'import math',
+        'OFFSET = 100',
+        'def make(step):',
+        '    def func(stop, start=0):',
+        '        i = start',
+        '        label .start',
+        '        if i >= stop:',
+        '            goto .end',
+        '        i += step',
+        '        goto .start',
+        '        label .end',
+        '        return math.floor(i) + OFFSET',
+        '    return func',
+    ]), ns)
+    func = with_goto(ns['make'](3))
+    func.attr = 'attr'
+
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        copy = pickle.loads(pickle.dumps(goto_module.picklable(func),
+                                         protocol))
+        assert copy(10) == 112
+        assert copy(10, start=1) == 110
+        assert copy.__name__ == 'func'
+        assert copy.attr == 'attr'
+        assert copy.__code__ == func.__code__
+
+
+@pytest.mark.skipif(sys.version_info < (3, 4),
+                    reason='dis.get_instructions() requires Python 3.4+')
+def test_decoder_matches_dis():
+    import dis
+
+    lines = ['x%d = %d' % (i, i) for i in range(300)]
+    lines += ['if x%d: x0 += 1' % i for i in range(0, 300, 100)]
+    func = make_function(lines)
+    code = func.__code__
+
+    expected = []
+    start = None
+    for instr in dis.get_instructions(code):
+        if start is None:
+            start = instr.offset
+        if instr.opname in ('EXTENDED_ARG', 'CACHE'):
+            continue
+        expected.append((instr.opcode, instr.arg or 0, start))
+        start = None
+
+    instructions = goto_module._Instructions(code.co_code)
+    assert instructions.count == len(expected)
+    assert list(zip(instructions.opcodes,
+                    instructions.args,
+                    instructions.offsets))[:instructions.count] == expected
+    assert any(arg > 255 for arg in instructions.args)
+
+
+def test_numpy_scan_matches_python(monkeypatch):
+    pytest.importorskip('numpy')
+
+    lines = ['result = 0']
+    for i in range(200):
+        lines += [
+            'for x in range(2):',
+            '    label .l%d' % i,
+            '    while result < x:',
+            '        result += 1',
+            '        if result > 10:',
+            '            goto .l%d' % i,
+        ]
+    code = make_function(lines).__code__
+
+    def find_labels_and_gotos():
+        labels, gotos = goto_module._find_labels_and_gotos(code)
+        return ({k: v[:2] + (blocks(v[2]),) for k, v in labels.items()},
+                [g[:3] + (blocks(g[3]),) + g[4:] for g in gotos])
+
+    def blocks(stack):
+        return [(b.type, b.target) for b in stack.blocks_until(None)]
+
+    monkeypatch.setattr(goto_module, '_NUMPY_SCAN_THRESHOLD', 0)
+    expected = find_labels_and_gotos()
+    monkeypatch.setattr(goto_module, '_numpy', False)
+    assert find_labels_and_gotos() == expected
+    assert len(expected[0]) == 200
+
+
+def test_block_stacks_are_shared():
+    lines = ['result = 0']
+    lines += ['for x in range(2):']
+    lines += ['    label .l%d' % i for i in range(3)]
+    lines += ['label .outside']
+    code = make_function(lines).__code__
+
+    labels, _ = goto_module._find_labels_and_gotos(code)
+    stacks = [stack for _, _, stack in labels.values()]
+    inner = [stack for stack in stacks if stack.depth > 0]
+    outer = [stack for stack in stacks if stack.depth == 0]
+
+    assert len(inner) == 3 and len(outer) == 1
+    assert inner[0] is inner[1] is inner[2]
+    assert inner[0].common_ancestor(outer[0]) is outer[0]
+    assert inner[0].type == 'FOR_ITER'
+    assert [block.type for block in inner[0].blocks_until(outer[0])] in (
+        ['FOR_ITER'], ['FOR_ITER', 'SETUP_LOOP'])
+
+
+def test_equal_consts_are_kept_apart():
+    @with_goto
+    def func():
+        consts = [False, 1.0]
+        goto.params .loop = iter('a'), iter('b')
+        for i in 'x':
+            for j in 'x':
+                label .loop
+                consts.append(None)
+        return consts
+
+    assert repr(func()) == repr([False, 1.0, None, None, None])
+
+
+def test_const_key():
+    key = goto_module._const_key
+    nan = float('nan')
+    assert key(1) != key(1.0) != key(True)
+    assert key(0.0) != key(-0.0)
+    assert key(nan) == key(float('nan'))
+    assert key((1,)) != key((True,))
+    assert key([]) != key([])
+
+
+@pytest.mark.parametrize('opname', ['NOP', 'LOAD_CONST', 'JUMP_FORWARD'])
+def test_encoder_matches_generic(opname):
+    bytecode = goto_module._BYTECODE
+    for oparg in (0, 1, 255, 256, 65535, 65536, 2 ** 24, 2 ** 31 - 1):
+        if bytecode.opcodes[opname] < bytecode.have_argument and oparg:
+            continue
+        expected = array.array('B', [0] * 16)
+        end = bytecode._write_generic(expected, 0, opname, oparg)
+        buf = array.array('B', [0] * 16)
+        assert bytecode.write_instruction(buf, 0, opname, oparg) == end
+        assert buf == expected
+        assert bytecode.instruction_size(opname, oparg) == end
+
+
+def test_compact():
+    def func():
+        result = []
+        i = 0
+        label .start
+        if i == 3:
+            goto .end
+        result.append(i)
+        i += 1
+        goto .start
+        label .end
+        return result
+
+    import dis
+    in_place = with_goto(func)
+    compact = with_goto(func, compact=True)
+    nop = dis.opmap['NOP']
+    assert compact() == in_place() == [0, 1, 2]
+    assert nop not in goto_module._Instructions(compact.__code__.co_code).opcodes
+    assert len(compact.__code__.co_code) < len(in_place.__code__.co_code)
+    assert with_goto(func.__code__, compact=True) is compact.__code__
+
+
+def test_compact_line_numbers():
+    import traceback
+
+    def func():
+        i = 0
+        label .start
+        i += 1
+        if i < 3:
+            goto .start
+        raise ValueError(i)
+
+    expected = func.__code__.co_firstlineno + 6
+    with pytest.raises(ValueError) as excinfo:
+        with_goto(func, compact=True)()
+    assert traceback.extract_tb(excinfo.tb)[-1][1] == expected
+
+
+def test_compact_extended_args():
+    # labels in reverse order, so most gotos jump backwards, and far
+    lines = ['result = []', 'goto .l0']
+    for i in reversed(range(300)):
+        lines.append('label .l%d' % i)
+        lines.append('result.append(%d)' % i)
+        lines.append('goto .l%d' % (i + 1))
+    lines.append('label .l300')
+    func = make_function(lines)
+
+    assert with_goto(func, compact=True)() == list(range(300))
+
+
+def make_labels_function(n_labels):
+    # n_labels labels, each also the target of a goto
+    lines = ['result = 0']
+    for i in range(n_labels):
+        lines.append('label .l%d' % i)
+        lines.append('result += 1')
+        lines.append('goto .l%d' % (i + 1))
+    lines.append('label .l%d' % n_labels)
+    return make_function(lines)
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_huge_function(compact):
+    func = make_labels_function(3000)
+    assert len(func.__code__.co_code) > 65536
+    assert len(func.__code__.co_names) > 256
+    assert with_goto(func, compact=compact)() == 3000
+
+
+def test_site_too_small_falls_back_to_assembler(monkeypatch):
+    def inject_ops(buf, pos, end, ops):
+        raise goto_module._SiteTooSmall()
+
+    monkeypatch.setattr(goto_module, '_inject_ops', inject_ops)
+    func = make_labels_function(10)
+    patched = with_goto(func)
+    assert patched() == 10
+    assert patched.__code__.co_code == \
+        with_goto(func, compact=True).__code__.co_code
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_patch_work_is_linear(monkeypatch, compact):
+    get_instruction_size = goto_module._get_instruction_size
+    options = goto_module._DEFAULT_OPTIONS._replace(compact=compact)
+
+    def count_size_calls(n_labels):
+        calls = [0]
+
+        def counting_get_instruction_size(*args):
+            calls[0] += 1
+            return get_instruction_size(*args)
+
+        monkeypatch.setattr(goto_module, '_get_instruction_size',
+                            counting_get_instruction_size)
+        code = make_labels_function(n_labels).__code__
+        goto_module._rewrite_code(code, options)
+        return calls[0]
+
+    assert count_size_calls(3000) <= count_size_calls(300) * 10
+
+
+def count_instructions(func):
+    # the number of instructions executed by func(), and its result
+    counts = [0]
+
+    def trace(frame, event, arg):
+        if frame.f_code is func.__code__:
+            frame.f_trace_opcodes = True
+            if event == 'opcode':
+                counts[0] += 1
+        return trace
+
+    sys.settrace(trace)
+    try:
+        result = func()
+    finally:
+        sys.settrace(None)
+    return counts[0], result
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="No opcode tracing")
+@pytest.mark.parametrize('compact', [False, True])
+def test_thread_jumps(compact):
+    def func():
+        result = []
+        i = 0
+        label .start
+        if i == 3:
+            goto .done
+        result.append(i)
+        i += 1
+        goto .loop
+        label .loop
+        goto .start
+        label .done
+        goto .end
+        label .end
+        return result
+
+    plain = with_goto(func, compact=compact)
+    threaded = with_goto(func, compact=compact, thread_jumps=True)
+    plain_count, plain_result = count_instructions(plain)
+    threaded_count, threaded_result = count_instructions(threaded)
+    assert threaded_result == plain_result == [0, 1, 2]
+    assert threaded_count < plain_count
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="No opcode tracing")
+@pytest.mark.parametrize('compact', [False, True])
+def test_thread_conditional_jump_to_goto(compact):
+    # if i is even, the conditional jump lands on `goto .loop`
+    def func():
+        result = []
+        i = 0
+        label .loop
+        if i == 4:
+            goto .end
+        i += 1
+        if i % 2:
+            result.append(i)
+        goto .loop
+        label .end
+        return result
+
+    plain_count, plain_result = count_instructions(
+        with_goto(func, compact=compact))
+    threaded_count, threaded_result = count_instructions(
+        with_goto(func, compact=compact, thread_jumps=True))
+    assert threaded_result == plain_result == [1, 3]
+    assert threaded_count < plain_count
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_thread_jumps_out_of_loop(compact):
+    def func():
+        result = []
+        for i in range(5):
+            result.append(i)
+            if i == 2:
+                goto .a
+        result.append(None)
+        label .a
+        goto .end
+        result.append(None)
+        label .end
+        return result
+
+    assert with_goto(func, compact=compact, thread_jumps=True)() == [0, 1, 2]
+
+
+def test_remove_dead_code():
+    import traceback
+
+    def func():
+        result = []
+        i = 0
+        label .start
+        if i == 3:
+            goto .end
+        result.append(i)
+        i += 1
+        goto .start
+        result.append('dead')
+        result.append('also dead')
+        label .end
+        if len(result) == 3:
+            raise ValueError(result)
+
+    removed = goto_module.memory_info().dead_code_bytes
+    compact = with_goto(func, compact=True)
+    patched = with_goto(func, remove_dead_code=True)
+    assert goto_module.memory_info().dead_code_bytes > removed
+    assert len(patched.__code__.co_code) < len(compact.__code__.co_code)
+
+    expected = func.__code__.co_firstlineno + 13
+    with pytest.raises(ValueError) as excinfo:
+        patched()
+    assert excinfo.value.args == ([0, 1, 2],)
+    assert traceback.extract_tb(excinfo.tb)[-1][1] == expected
+
+
+@pytest.mark.xfail(not try_finally_supported, reason="No try/finally patching support")
+def test_remove_dead_code_keeps_handlers():
+    def func():
+        c = Context()
+        for i in range(3):
+            with c:
+                if i == 1:
+                    goto .out
+            label .out
+        goto .end
+        c = None
+        label .end
+        return (i, c.data())
+
+    assert with_goto(func, remove_dead_code=True)() == (2, (3, 2))
+
+
+@pytest.mark.parametrize('options', [{}, {'compact': True},
+                                     {'remove_dead_code': True},
+                                     {'remove_dead_code': True, 'thread_jumps': True}])
+def test_constants(options):
+    # TRACE and PREFIX are never defined, so they must not be looked up
+    def func():
+        result = []
+        i = 0
+        label .start
+        if TRACE:
+            goto .trace
+        label .back
+        if not TRACE:
+            result.append(PREFIX)
+        if i == 2:
+            goto .end
+        result.append(i)
+        i += 1
+        goto .start
+        label .trace
+        result.append('trace')
+        goto .back
+        label .end
+        return result
+
+    patched = with_goto(func, constants={'TRACE': False, 'PREFIX': '-'},
+                        **options)
+    assert patched() == ['-', 0, '-', 1, '-']
+    patched = with_goto(func, constants={'TRACE': 1}, **options)
+    assert patched() == ['trace', 0, 'trace', 1, 'trace']
+
+
+def test_constants_drop_dead_arms():
+    def func():
+        result = []
+        if TRACE:
+            result.append('trace')
+            result.append('more trace')
+        return result
+
+    compact = with_goto(func, compact=True, constants={'TRACE': False})
+    patched = with_goto(func, remove_dead_code=True, constants={'TRACE': False})
+    assert patched() == compact() == []
+    assert len(patched.__code__.co_code) < len(compact.__code__.co_code)
+
+
+def test_constants_equal_values_are_cached_apart(tmpdir):
+    from decimal import Decimal
+    patched = []
+    for value in [Decimal('1.0'), Decimal('1.00')]:
+        func = make_function(['result = A'])
+        patched.append(with_goto(func, constants={'A': value}))
+        assert patched[-1]() is value
+
+    # ...and aren't copied by the disk cache
+    goto_module.set_cache_dir(str(tmpdir))
+    try:
+        for value in ([], []):
+            func = make_function(['result = A'])
+            patched.append(with_goto(func, constants={'A': value}))
+            assert patched[-1]() is value
+        assert not tmpdir.listdir()
+    finally:
+        goto_module.set_cache_dir(None)
+
+
+BOUND_LIMIT = 3
+
+
+def bound_helper(i):
+    return i * 2
+
+
+def test_bind_globals():
+    global BOUND_LIMIT
+
+    def func():
+        result = []
+        i = 0
+        label .start
+        if i == BOUND_LIMIT:
+            goto .end
+        result.append(bound_helper(i))
+        i += len('x')
+        goto .start
+        label .end
+        return result
+
+    patched = with_goto(func, bind_globals=True)
+    lazy = with_goto(func, bind_globals=True, lazy=True)
+    listed = with_goto(func, bind_globals=['bound_helper'])
+    excluded = with_goto(func, bind_globals=True, bind_exclude=['BOUND_LIMIT'])
+    BOUND_LIMIT = 2
+    try:
+        assert patched() == [0, 2, 4]
+        assert lazy() == [0, 2]
+        assert listed() == [0, 2]
+        assert excluded() == [0, 2]
+    finally:
+        BOUND_LIMIT = 3
+
+    pytest.raises(TypeError, with_goto, func.__code__, bind_globals=True)
+
+
+def test_bind_globals_skips_assigned_names():
+    def func():
+        global BOUND_LIMIT
+        BOUND_LIMIT = 5
+        return BOUND_LIMIT
+
+    try:
+        assert with_goto(func, bind_globals=True)() == 5
+    finally:
+        globals()['BOUND_LIMIT'] = 3
+
+
+def test_bind_globals_keeps_equal_values_apart():
+    from decimal import Decimal
+    ns = {'A': Decimal('1.0'), 'B': Decimal('1.00'), 'C': [], 'D': []}
+    exec('def func():\n    return A, B, C, D\n', ns)
+
+    result = with_goto(ns['func'], bind_globals=True)()
+    assert all(x is y for x, y in zip(result, (ns['A'], ns['B'],
+                                               ns['C'], ns['D'])))
+
+    func = make_function(['result = A, B'])
+    result = with_goto(func, constants={'A': ns['A'], 'B': ns['B']})()
+    assert result[0] is ns['A'] and result[1] is ns['B']
+
+
+def test_jump_into_3_loops_unpacks_params():
+    def func():
+        result = []
+        goto.params .loop = iter('ab'), iter('c'), iter('de')
+        for i in 'x':
+            result.append(i)
+            for j in 'y':
+                result.append(j)
+                for k in 'z':
+                    result.append(k)
+                    label .loop
+        return ''.join(result)
+
+    import dis
+    patched = with_goto(func)
+    assert patched() == 'deczayzbyz'
+    # a single slice, however deep the goto jumps
+    assert goto_module._Instructions(patched.__code__.co_code).opcodes \
+        .count(dis.opmap['BINARY_SUBSCR']) == 1
+
+
+def max_stack_depth(code):
+    # the deepest the stack can get, following every path through code
+    import dis
+    instructions = list(dis.get_instructions(code))
+    index = dict((ins.offset, i) for i, ins in enumerate(instructions))
+    no_fallthrough = ('RETURN_VALUE', 'RAISE_VARARGS', 'RERAISE',
+                      'JUMP_ABSOLUTE', 'JUMP_FORWARD')
+    depths = {0: 0}
+    todo = [0]
+    while todo:
+        i = todo.pop()
+        ins = instructions[i]
+        arg = ins.arg if ins.opcode >= dis.HAVE_ARGUMENT else None
+        successors = []
+        if ins.opname not in no_fallthrough:
+            successors.append((i + 1, dis.stack_effect(ins.opcode, arg,
+                                                       jump=False)))
+        if ins.opcode in dis.hasjrel or ins.opcode in dis.hasjabs:
+            successors.append((index[ins.argval],
+                               dis.stack_effect(ins.opcode, arg, jump=True)))
+        for j, effect in successors:
+            depth = depths[i] + effect
+            if depth > depths.get(j, -1):
+                depths[j] = depth
+                todo.append(j)
+    return max(depths.values())
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8), reason="No dis.stack_effect(jump=)")
+@pytest.mark.parametrize('compact', [False, True])
+def test_jump_params_out_of_deep_nesting(compact):
+    def func():
+        result = []
+        # (built in advance, so it doesn't make the stack any deeper)
+        params = tuple(iter(x) for x in '123456')
+        for a in 'a':
+            for b in 'b':
+                for c in 'c':
+                    for d in 'd':
+                        for e in 'e':
+                            for f in 'f':
+                                goto.params .inner = params
+        for i in 'x':
+            for j in 'x':
+                for k in 'x':
+                    for m in 'x':
+                        for n in 'x':
+                            for o in 'x':
+                                label .inner
+                                result.append(len(result))
+        return result
+
+    patched = with_goto(func, compact=compact)
+    code = patched.__code__
+    assert max_stack_depth(code) <= code.co_stacksize
+    # one value is left in each of the iterators jumped into
+    assert patched() == list(range(7))
+
+
+def test_jump_into_loops_ignores_extra_params():
+    @with_goto
+    def func():
+        result = []
+        goto.params .loop = iter('a'), iter('b'), 'extra'
+        for i in 'x':
+            for j in 'y':
+                result.append(j)
+                label .loop
+        return ''.join(result)
+
+    assert func() == 'by'